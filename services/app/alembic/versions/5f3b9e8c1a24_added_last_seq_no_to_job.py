@@ -0,0 +1,29 @@
+"""Added last seq no to job
+
+Revision ID: 5f3b9e8c1a24
+Revises: c4e1a7d2b3f0
+Create Date: 2026-10-18 11:20:07.524113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f3b9e8c1a24'
+down_revision = 'c4e1a7d2b3f0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('job', sa.Column('last_seq_no', sa.Integer(), server_default='0', nullable=False))
+    op.execute("""
+        UPDATE job SET last_seq_no = message_seq.max_seq_no
+        FROM (SELECT job_no, max(seq_no) AS max_seq_no FROM message GROUP BY job_no) AS message_seq
+        WHERE job.job_no = message_seq.job_no
+    """)
+
+
+def downgrade() -> None:
+    op.drop_column('job', 'last_seq_no')
@@ -0,0 +1,24 @@
+"""Added last seen tag to metrics
+
+Revision ID: 7a3c5e9d2f48
+Revises: e2d8a4f61b07
+Create Date: 2026-10-18 13:41:09.772630
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7a3c5e9d2f48'
+down_revision = 'e2d8a4f61b07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('metrics', sa.Column('last_seen_tag', sa.String(length=120), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('metrics', 'last_seen_tag')
@@ -0,0 +1,39 @@
+"""Added indexes for hot lookups
+
+Revision ID: c4e1a7d2b3f0
+Revises: 9b2a00f6cdcc
+Create Date: 2026-10-18 10:02:41.318204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e1a7d2b3f0'
+down_revision = '9b2a00f6cdcc'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # users.number is already indexed by users_number_key
+    op.create_index('ix_message_job_no_seq_no', 'message', ['job_no', 'seq_no'], unique=False)
+    op.create_index('ix_message_confirm_ref_msg_sid', 'message_confirm', ['ref_msg_sid'], unique=False)
+    op.create_index('ix_job_created_at', 'job', ['created_at'], unique=False)
+    op.create_index('ix_job_user_name', 'job_user', ['name'], unique=False)
+    op.create_index('ix_job_unknown_from_no', 'job_unknown', ['from_no'], unique=False)
+    op.create_index('ix_leave_records_job_no_date', 'leave_records', ['job_no', 'date'], unique=False)
+    op.create_index('ix_leave_records_date', 'leave_records', ['date'], unique=False)
+    op.create_index('ix_leave_records_date_active', 'leave_records', ['date'], unique=False, postgresql_where=sa.text('NOT is_cancelled'))
+
+
+def downgrade() -> None:
+    op.drop_index('ix_leave_records_date_active', table_name='leave_records', postgresql_where=sa.text('NOT is_cancelled'))
+    op.drop_index('ix_leave_records_date', table_name='leave_records')
+    op.drop_index('ix_leave_records_job_no_date', table_name='leave_records')
+    op.drop_index('ix_job_unknown_from_no', table_name='job_unknown')
+    op.drop_index('ix_job_user_name', table_name='job_user')
+    op.drop_index('ix_job_created_at', table_name='job')
+    op.drop_index('ix_message_confirm_ref_msg_sid', table_name='message_confirm')
+    op.drop_index('ix_message_job_no_seq_no', table_name='message')
@@ -0,0 +1,24 @@
+"""Added last catch up to metrics
+
+Revision ID: c4e8b2a6d913
+Revises: 7a3c5e9d2f48
+Create Date: 2026-10-18 16:02:37.418205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8b2a6d913'
+down_revision = '7a3c5e9d2f48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('metrics', sa.Column('last_catch_up', sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('metrics', 'last_catch_up')
@@ -0,0 +1,37 @@
+"""Added leave record changes
+
+Revision ID: e2d8a4f61b07
+Revises: 5f3b9e8c1a24
+Create Date: 2026-10-18 13:02:41.318205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2d8a4f61b07'
+down_revision = '5f3b9e8c1a24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table('leave_record_changes',
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.Column('record_id', sa.String(length=80), nullable=False),
+    sa.Column('action', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), nullable=False),
+    sa.Column('processed_at', sa.DateTime(timezone=True), nullable=True),
+    sa.ForeignKeyConstraint(['record_id'], ['leave_records.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_leave_record_changes_pending', 'leave_record_changes', ['id'], unique=False, postgresql_where=sa.text('processed_at IS NULL'))
+    # no backfill, the first sync after the upgrade is a full reconciliation since no job_sync_records row has is_full_sync set
+    op.add_column('job_sync_records', sa.Column('is_full_sync', sa.Boolean(), server_default='false', nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column('job_sync_records', 'is_full_sync')
+    op.drop_index('ix_leave_record_changes_pending', table_name='leave_record_changes', postgresql_where=sa.text('processed_at IS NULL'))
+    op.drop_table('leave_record_changes')
@@ -5,18 +5,19 @@ load_dotenv(dotenv_path=env_path)
 import os
 from datetime import datetime
 
-from flask import Flask, request, Response
+from flask import Flask, request, Response, jsonify
 from flask.cli import with_appcontext
 import logging
 import traceback
 from sqlalchemy import inspect, event
 
-from manage import create_app
+from manage import get_app, registry_stats
 from extensions import db
 
 from models.users import User
 from models.messages.received import MessageReceived
 from models.messages.abstract import Message
+from models.jobs.abstract import Job, EARLY_CALLBACK_STATUSES
 
 from tasks import main as create_task
 
@@ -24,11 +25,8 @@ from es.manage import loop_through_files, create_index
 
 from constants import system, PROCESSING, PENDING_USER_REPLY, OK
 
-import os
-from sqlalchemy import create_engine
-from extensions import init_thread_session
-
 from utilities import log_level
+from counters import counters
 
 # Configure the root logger
 logging.basicConfig(
@@ -47,7 +45,7 @@ logging.getLogger('twilio.http_client').setLevel(logging.WARNING)
 # file_handler.setFormatter(formatter)
 # logger.addHandler(file_handler)
 
-app = create_app()
+app = get_app()
 
 
 @app.cli.command("setup_azure")
@@ -124,6 +122,12 @@ def sms_reply():
         
         if job_enqueued:
             logging.info("job enqueued")
+
+            if app.redis_client.async_jobs:
+                # acknowledge Twilio immediately, worker.py runs the job
+                app.redis_client.dispatch_next_job(encoded_no)
+                return "job enqueued", OK
+
             result = app.redis_client.start_next_job(encoded_no)
 
             if result:
@@ -157,12 +161,18 @@ def sms_reply_callback():
         sid = request.values.get('MessageSid')
 
         logging.info(f"callback received, status: {status}, sid: {sid}")
+
+        if app.redis_client.async_callbacks:
+            app.redis_client.add_callback_event(sid, status, request.form.get("To"))
+            return Response(status=200)
         
         # check if this is a forwarded message, which would have its own ID
         message = Message.get_message_by_sid(sid)
 
         if not message:
             logging.info(f"not a message, {sid}")
+            if status in EARLY_CALLBACK_STATUSES: # may be a forward which is not committed yet
+                Job.stash_early_callbacks({sid: {"status": status, "to": request.form.get("To"), "sent": False}})
 
         else:
             job = message.job
@@ -180,6 +190,11 @@ def sms_reply_callback():
 
     return Response(status=200)
 
+@app.route("/chatbot/counters/", methods=['GET'])
+def show_counters():
+    """Counters and timings of this worker process."""
+    return jsonify(dict(counters.snapshot(), registry=registry_stats()))
+
 if __name__ == "__main__":
     # local development, not for gunicorn
     app.run(debug=True)
\ No newline at end of file
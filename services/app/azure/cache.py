@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+
+import redis
+
+from counters import counters
+from logs.config import setup_logger
+
+TABLE_URL_TTL = 24 * 60 * 60 # seconds a table url is kept in Redis, JobAcqToken revalidates them every 30 minutes anyway
+LEAVE_SHEETS_TTL = 6 * 60 * 60 # seconds the leave folder's month -> worksheet index is reused, SpreadsheetManager drops it when it adds a worksheet
+MEMO_TTL = 300 # seconds a process reuses a value before reading Redis again, so invalidations from other processes are picked up
+
+class TTLCache:
+    '''
+    String values shared by every process through Redis under {prefix}:{key}, each expiring after ttl seconds, with an in-process memo in front so repeated reads in a run do not go to Redis.
+
+    Writes are single SET commands with an expiry, so concurrent runs cannot leave a half written value the way they could with a json file. If Redis is down the cache degrades to the memo alone. Values for which validate returns False are treated as missing
+    '''
+
+    logger = setup_logger('az.cache')
+
+    def __init__(self, prefix, ttl, memo_ttl=MEMO_TTL, validate=None, url=None):
+        self.prefix = prefix
+        self.ttl = ttl
+        self.memo_ttl = memo_ttl
+        self.validate = validate
+        self.url = url
+        self._memo = {}
+        self._memo_lock = threading.Lock()
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from redis_client import get_connection_pool
+            self._client = redis.Redis(connection_pool=get_connection_pool(self.url or os.getenv("REDIS_URL"))) # the shared pool returns bytes, decoded below
+        return self._client
+
+    def key(self, key):
+        return f"{self.prefix}:{key}"
+
+    def get(self, key):
+        with self._memo_lock:
+            memo = self._memo.get(key)
+        if memo and memo[1] > time.monotonic():
+            counters.incr(f"cache.{self.prefix}.memo_hits")
+            return memo[0]
+
+        try:
+            value = self.client.get(self.key(key))
+        except redis.RedisError as e:
+            self.logger.error(f"could not read {self.key(key)}: {e}")
+            value = None
+
+        if isinstance(value, bytes):
+            value = value.decode()
+
+        if value is not None and self.validate and not self.validate(value):
+            self.logger.info(f"discarding invalid value for {self.key(key)}: {value}")
+            self.delete(key)
+            value = None
+
+        if value is None:
+            counters.incr(f"cache.{self.prefix}.misses")
+            with self._memo_lock:
+                self._memo.pop(key, None)
+            return None
+
+        counters.incr(f"cache.{self.prefix}.hits")
+        self._remember(key, value)
+        return value
+
+    def set(self, key, value):
+        try:
+            self.client.set(self.key(key), value, ex=self.ttl)
+        except redis.RedisError as e:
+            self.logger.error(f"could not write {self.key(key)}: {e}")
+        self._remember(key, value)
+
+    def delete(self, key):
+        with self._memo_lock:
+            self._memo.pop(key, None)
+        try:
+            self.client.delete(self.key(key))
+        except redis.RedisError as e:
+            self.logger.error(f"could not delete {self.key(key)}: {e}")
+
+    def items(self):
+        '''every key and value currently in Redis, read in one pass'''
+        try:
+            keys = list(self.client.scan_iter(match=self.key("*")))
+            values = self.client.mget(keys) if keys else []
+        except redis.RedisError as e:
+            self.logger.error(f"could not list {self.prefix}: {e}")
+            return {}
+
+        prefix_len = len(self.prefix) + 1
+        return {
+            (key.decode() if isinstance(key, bytes) else key)[prefix_len:]: value.decode() if isinstance(value, bytes) else value
+            for key, value in zip(keys, values) if value is not None
+        }
+
+    def lock(self, key, ttl=120, timeout=120):
+        '''RedisLock held while a missing value is being created, so concurrent runs do not create it twice'''
+        from redis_client import RedisLock
+        return RedisLock(self.client, self.key(key), ttl=ttl, timeout=timeout)
+
+    def _remember(self, key, value):
+        with self._memo_lock:
+            self._memo[key] = (value, time.monotonic() + self.memo_ttl)
+
+def is_table_url(value):
+    return value.startswith("https://graph.microsoft.com/v1.0/drives/") and "/workbook/worksheets/" in value and "/tables/" in value
+
+# month tables by "{month name}-{year}", shared by SpreadsheetManager and JobAcqToken
+table_urls = TTLCache("table_url", ttl=TABLE_URL_TTL, validate=is_table_url)
+
+# the month -> worksheet url index of the leave folder as json under "index", see azure.utils.get_leave_sheet_index
+leave_sheets = TTLCache("leave_sheets", ttl=LEAVE_SHEETS_TTL)
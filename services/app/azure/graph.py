@@ -0,0 +1,59 @@
+import os
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from counters import counters
+from logs.config import setup_logger
+
+GRAPH_TIMEOUT = (5, 60) # connect and read timeouts in seconds, bare requests calls had none
+GRAPH_MAX_CONNECTIONS = int(os.getenv("GRAPH_MAX_CONNECTIONS", 10)) # per host
+
+class GraphSession(requests.Session):
+    '''
+    The requests.Session shared by every call to the Graph API (and the SharePoint download urls it returns), so that connections are kept alive between calls instead of a new TLS handshake per request.
+
+    Each host gets a pool of at most GRAPH_MAX_CONNECTIONS connections, callers block for a free connection beyond that. Every request gets GRAPH_TIMEOUT unless it passes its own, and is timed in counters under graph.{method}. A 401 is retried once with a refreshed token
+    '''
+
+    logger = setup_logger('az.graph')
+
+    def __init__(self, max_connections=GRAPH_MAX_CONNECTIONS, timeout=GRAPH_TIMEOUT):
+        super().__init__()
+        self.timeout = timeout
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_connections, pool_block=True)
+        self.mount("https://", adapter)
+        self.headers.update({"Accept-Encoding": "gzip, deflate"})
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        try:
+            with counters.timer(f"graph.{method.lower()}"):
+                response = super().request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            counters.incr("graph.connection_errors")
+            raise
+        counters.incr(f"graph.status.{response.status_code}")
+
+        headers = kwargs.get("headers")
+        if response.status_code == 401 and headers and headers.get("Authorization"):
+            response = self.retry_unauthorized(method, url, **kwargs)
+        return response
+
+    def retry_unauthorized(self, method, url, **kwargs):
+        '''
+        Retries a 401 once with a fresh token from token_provider. Concurrent 401s for the same token share one refresh.
+
+        The new token is written into the caller's headers dict, which jobs build once and reuse, so their next calls do not hit the 401 again
+        '''
+        from azure.token_provider import token_provider
+
+        counters.incr("graph.unauthorized_retries")
+        headers = kwargs["headers"]
+        headers["Authorization"] = token_provider.refresh(stale_token=headers["Authorization"])
+        with counters.timer(f"graph.{method.lower()}"):
+            response = super().request(method, url, **kwargs)
+        counters.incr(f"graph.status.{response.status_code}")
+        return response
+
+graph = GraphSession()
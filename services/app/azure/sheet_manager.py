@@ -1,18 +1,30 @@
 from datetime import datetime, timedelta, time
 import os
-import requests
 import numpy as np
 import pandas as pd
 import json
 
 import logging
+import threading
 import traceback
 
-from azure.utils import generate_header, delay_decorator
+from azure.utils import generate_header, delay_decorator, graph_batch, cached_leave_sheet_index, NEW_WORKBOOK_RETRYABLE_STATUSES, GRAPH_BATCH_LIMIT
+from azure.graph import graph
+from azure.cache import table_urls, leave_sheets
+from models.exceptions import LockTimeoutError, AzureSyncError
+import redis
 from utilities import current_sg_time, get_latest_date_past_9am
 from logs.config import setup_logger
 import calendar
 
+# one lock per year, held while a table url of that year is resolved or created in this process. The months of a sync resolve theirs on parallel threads (see JobSyncRecords.sync_months), months of different years do not wait for each other
+_create_locks = {}
+_create_locks_lock = threading.Lock()
+
+def _create_lock(year):
+    with _create_locks_lock:
+        return _create_locks.setdefault(year, threading.Lock())
+
 class SpreadsheetManager:
 
     def __init__(self, mmyy=None, user=None, token=None, dev=False):
@@ -56,27 +68,30 @@ class SpreadsheetManager:
         # self.logger.info(self.query_book_url)
         # self.logger.info(self.headers)
 
-        if not self.dev:
-            url_cache='/home/app/web/logs/table_urls.json'
-        else:
-            url_cache='table_urls.json'
-
-        if os.path.exists(url_cache) and os.path.getsize(url_cache) > 0:
-            mode = 'r+'
-        else:
-            mode = 'w+'
+        table_url = table_urls.get(self.mmyy)
+        if table_url:
+            return table_url
 
-        with open(url_cache, mode) as file:
+        # locked per year rather than per month, in this process and across processes (the Redis lock), two months of a book that does not exist yet would both upload it and the second upload replaces the first month's worksheet, and two months can race adding worksheets to the same book
+        with _create_lock(self.year):
             try:
-                table_url_dict = json.loads(file.read())
-                table_url = table_url_dict.get(self.mmyy)
-                if table_url:
-                    self.logger.info("URL FOUND IN CACHE")
-                    return table_url
-            except json.JSONDecodeError:
-                self.logger.info(traceback.format_exc())
-                table_url_dict = {}
-                file.write(json.dumps(table_url_dict))
+                with table_urls.lock(f"book:{self.year}"):
+                    # another run may have created the table while we waited
+                    return table_urls.get(self.mmyy) or self.create_table_url()
+            except (redis.RedisError, LockTimeoutError):
+                self.logger.error(traceback.format_exc())
+                return table_urls.get(self.mmyy) or self.create_table_url()
+
+    def create_table_url(self):
+        # the worksheet is usually already in the index cached by loop_leave_files, which saves listing the folder and the book
+        worksheet_url = cached_leave_sheet_index().get(self.mmyy)
+        if worksheet_url:
+            try:
+                table_url = self.get_table_url(worksheet_url)
+                table_urls.set(self.mmyy, table_url)
+                return table_url
+            except AzureSyncError:
+                self.logger.error(traceback.format_exc())
 
         worksheets_url, new_book = self.get_sheets_url()
 
@@ -92,18 +107,16 @@ class SpreadsheetManager:
         if new_book == True:
             self.deleteSheet1(worksheets_url)
 
-        with open(url_cache, 'r+') as file:
-            file.seek(0)
-            table_url_dict[self.mmyy] = table_url
-            file.write(json.dumps(table_url_dict, indent=4))
-            file.truncate()
+        # the index was missing or stale, or a book or worksheet was just added
+        leave_sheets.delete("index")
+        table_urls.set(self.mmyy, table_url)
 
         return table_url
 
     def get_sheets_url(self):
         @delay_decorator("Could not check if book exists")
         def _get_sheets_url():
-            response = requests.get(url=self.query_book_url, headers=self.headers)
+            response = graph.get(url=self.query_book_url, headers=self.headers)
             return response
         
         new_book = False
@@ -125,7 +138,7 @@ class SpreadsheetManager:
         def _get_sheet_url():
 
             # get the worksheet names
-            response = requests.get(url=worksheets_url, headers=self.headers)
+            response = graph.get(url=worksheets_url, headers=self.headers)
             return response
         
         response = _get_sheet_url()
@@ -150,7 +163,7 @@ class SpreadsheetManager:
         @delay_decorator("Could not get the tables")
         def get_tables():
 
-            response = requests.get(url=tables_url, headers=self.headers)
+            response = graph.get(url=tables_url, headers=self.headers)
             return response
         
         response = get_tables()
@@ -178,7 +191,7 @@ class SpreadsheetManager:
         @delay_decorator("Failed to upload file")
         def _create_book():
             # uploads the file
-            response = requests.put(self.create_book_url, headers=self.headers, data=file_data)
+            response = graph.put(self.create_book_url, headers=self.headers, data=file_data)
             return response
 
         with open(self.template_path, 'rb') as file_data:
@@ -199,7 +212,7 @@ class SpreadsheetManager:
             }
 
             # add the worksheet
-            response = requests.post(url=f"{worksheets_url}/add", headers=self.headers, json=body)
+            response = graph.post(url=f"{worksheets_url}/add", headers=self.headers, json=body)
             return response
         
         response = _add_worksheet()
@@ -211,7 +224,7 @@ class SpreadsheetManager:
     def add_table(self, worksheet_url, name):
 
         # ADD TABLE HEADERS
-        @delay_decorator("Table headers could not be initialised.", retries = 10)
+        @delay_decorator("Table headers could not be initialised.", retries = 10, retryable_statuses = NEW_WORKBOOK_RETRYABLE_STATUSES)
         def _add_table_headers():
             table_headers_url = f"{worksheet_url}/range(address='A1:E1')"
 
@@ -219,11 +232,11 @@ class SpreadsheetManager:
                 "values": [["id", "Date", "Name", "Department", "Type"]]
             }
 
-            response = requests.patch(table_headers_url, headers=self.headers, json=header_values)
+            response = graph.patch(table_headers_url, headers=self.headers, json=header_values)
             return response
 
         # ADD TABLE
-        @delay_decorator("Table itself could not be initialised.", retries = 10)
+        @delay_decorator("Table itself could not be initialised.", retries = 10, retryable_statuses = NEW_WORKBOOK_RETRYABLE_STATUSES)
         def _add_table():
             add_table_url = f"{worksheet_url}/tables/add"
 
@@ -232,11 +245,11 @@ class SpreadsheetManager:
                 "hasHeaders": True,
             }
 
-            response = requests.post(add_table_url, headers=self.headers, json=body)
+            response = graph.post(add_table_url, headers=self.headers, json=body)
             return response
 
         # CHANGE TABLE NAME
-        @delay_decorator("Table name could not be changed. There might be tables with duplicate names.", retries = 10)
+        @delay_decorator("Table name could not be changed. There might be tables with duplicate names.", retries = 10, retryable_statuses = NEW_WORKBOOK_RETRYABLE_STATUSES)
         def _change_tablename(table_id):
             change_tablename_url = f"{worksheet_url}/tables/{table_id}"
 
@@ -244,7 +257,7 @@ class SpreadsheetManager:
                 "name": name
             }
 
-            response = requests.patch(change_tablename_url, headers=self.headers, json=table_options)
+            response = graph.patch(change_tablename_url, headers=self.headers, json=table_options)
             return response
         
         # see delay_decorator for more info
@@ -271,7 +284,7 @@ class SpreadsheetManager:
         @delay_decorator("Failed to delete Sheet1")
         def _deleteSheet1():
             # delete the sheet
-            response = requests.delete(del_sheet1_url, headers=self.headers)
+            response = graph.delete(del_sheet1_url, headers=self.headers)
             return response
         
         _deleteSheet1()
@@ -292,7 +305,7 @@ class SpreadsheetManager:
 
         @delay_decorator("Table itself could not be initialised.", retries = 10)
         def _find_current_dates(url):
-            response = requests.get(url=url, headers=self.headers)
+            response = graph.get(url=url, headers=self.headers)
             return response
         
 
@@ -357,9 +370,10 @@ class SpreadsheetManager:
         # write to file
         write_to_table_url = f"{self.table_url}/rows"
 
-        @delay_decorator("Failed to upload data.")
+        # adding rows is not idempotent, a read timeout may come after Graph added them
+        @delay_decorator("Failed to upload data.", retry_read_timeouts = False)
         def _write_to_excel():
-            response = requests.post(write_to_table_url, headers=self.headers, json = json)
+            response = graph.post(write_to_table_url, headers=self.headers, json = json)
             self.logger.info(response.json())
             return response
         
@@ -382,14 +396,9 @@ class SpreadsheetManager:
         # delete from file
         remove_from_table_url = f"{self.table_url}/rows/"
 
-        @delay_decorator("Failed to delete data.")
-        def _delete_from_excel(index):
-            remove_index_url = remove_from_table_url + f"ItemAt(index={str(index)})"
-            self.logger.info(remove_index_url)
-            response = requests.delete(remove_index_url, headers=self.headers)
-            return response
-        
         sorted_indexes = sorted(indexes, reverse=True)
-        for index in sorted_indexes:
-            _delete_from_excel(index)
+        operations = [("DELETE", remove_from_table_url + f"ItemAt(index={str(index)})", None) for index in sorted_indexes]
+        self.logger.info(f"deleting rows {sorted_indexes} in {-(-len(operations) // GRAPH_BATCH_LIMIT)} batches")
 
+        # descending and sequential, so that each deletion leaves the indexes of the rows still to be deleted unchanged. The deletes are positional, so graph_batch does not resend them after a read timeout
+        graph_batch(operations, self.headers, "Failed to delete data.")
@@ -0,0 +1,126 @@
+import fcntl
+import os
+import threading
+import time
+
+import msal
+
+from counters import counters
+from logs.config import setup_logger
+from models.exceptions import AzureSyncError
+
+REFRESH_MARGIN = 300 # seconds before expiry a token is replaced, so a Graph call never starts with a token about to lapse
+
+class TokenProvider:
+    '''
+    Holds the app-only Graph token in memory for every Graph caller of the process, replacing the token file JobAcqToken used to write and generate_header used to read on every call.
+
+    A token is reused until REFRESH_MARGIN seconds before its expires_in, then replaced under a lock so concurrent callers refresh once. The MSAL cache is persisted to MSAL_CACHE_PATH when it is set, so short lived processes like the cron tasks pick up the token of the previous run instead of requesting a new one
+    '''
+
+    logger = setup_logger('az.token_provider')
+
+    def __init__(self, client_id=None, client_secret=None, authority=None, scope=None, cache_path=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.authority = authority
+        self.scope = [scope]
+        self.cache_path = cache_path
+        self.cache = msal.SerializableTokenCache()
+        self._app = None
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0
+
+    @property
+    def app(self):
+        if self._app is None:
+            self.load_cache()
+            self._app = msal.ConfidentialClientApplication(self.client_id, authority=self.authority, client_credential=self.client_secret, token_cache=self.cache)
+        return self._app
+
+    def load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        with open(self.cache_path, 'r') as file:
+            fcntl.flock(file, fcntl.LOCK_SH)
+            data = file.read()
+        if data:
+            self.cache.deserialize(data)
+
+    def save_cache(self):
+        if not self.cache_path or not self.cache.has_state_changed:
+            return
+        # rewritten in place under a lock rather than replaced, the path can be a bind mounted file
+        with open(self.cache_path, 'a+') as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            file.seek(0)
+            file.truncate()
+            file.write(self.cache.serialize())
+        self.cache.has_state_changed = False
+
+    def get_token(self):
+        '''returns the Authorization header value, refreshing the token when it is close to expiry'''
+        if self._token and time.time() < self._expires_at - REFRESH_MARGIN:
+            return self._token
+
+        with self._lock:
+            if self._token and time.time() < self._expires_at - REFRESH_MARGIN:
+                return self._token
+            return self._acquire()
+
+    def refresh(self, stale_token=None):
+        '''
+        Drops the cached token and acquires a new one, used when Graph answers 401.
+
+        If stale_token is given and another caller already replaced it, the current token is returned instead, so a burst of 401s refreshes once
+        '''
+        with self._lock:
+            if stale_token and self._token and self._token != stale_token:
+                return self._token
+            self.clear_access_tokens()
+            return self._acquire()
+
+    def clear_access_tokens(self):
+        self._token = None
+        for access_token in self.cache.find(msal.TokenCache.CredentialType.ACCESS_TOKEN):
+            self.cache.remove_at(access_token)
+
+    def _acquire(self):
+        result = self._request_token()
+        if int(result.get('expires_in', 0)) <= REFRESH_MARGIN:
+            # the cached token is still valid to MSAL but too close to expiry for us
+            self.clear_access_tokens()
+            result = self._request_token()
+
+        self.save_cache()
+
+        self._token = 'Bearer ' + result['access_token']
+        self._expires_at = time.time() + int(result.get('expires_in', 0))
+        return self._token
+
+    def _request_token(self):
+        '''acquire_token_for_client only goes to Entra ID when the MSAL cache has no valid token'''
+        try:
+            result = self.app.acquire_token_for_client(scopes=self.scope)
+        except Exception as e:
+            self.logger.error(f"token request failed: {e}")
+            result = None
+
+        if not result or 'access_token' not in result:
+            error = result.get('error_description') if result else None
+            self.logger.error(f"no access token: {error}")
+            counters.incr("token_provider.failures")
+            raise AzureSyncError("Failed to retrieve token. Likely due to Client Secret Expiration. To create a new Client Secret, go to Microsoft Entra ID → Applications → App Registrations → Chatbot → Certificates & Secrets → New client secret. Then update the .env file and restart Docker")
+
+        if result.get('token_source') != 'cache':
+            counters.incr("token_provider.requests")
+        return result
+
+token_provider = TokenProvider(
+    client_id=os.environ.get('CLIENT_ID'),
+    client_secret=os.environ.get('CLIENT_SECRET'),
+    authority=os.environ.get('AUTHORITY'),
+    scope=os.environ.get('SCOPE'),
+    cache_path=os.environ.get('MSAL_CACHE_PATH'),
+)
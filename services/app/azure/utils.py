@@ -1,8 +1,17 @@
 import os
 import requests
-from datetime import datetime
+import urllib3
+from azure.graph import graph, GRAPH_MAX_CONNECTIONS
+from azure.cache import leave_sheets
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from functools import wraps
+import json
 import logging
+import random
 import time
+from counters import counters
 from utilities import current_sg_time
 from models.exceptions import AzureSyncError
 
@@ -11,8 +20,8 @@ from logs.config import setup_logger
 def generate_header(token=None):
     
     if not token:
-        with open(os.environ.get('TOKEN_PATH'), 'r') as file:
-            token = file.read().strip()
+        from azure.token_provider import token_provider
+        token = token_provider.get_token()
 
     headers = {
         'Authorization': token,
@@ -21,61 +30,257 @@ def generate_header(token=None):
 
     return headers
 
-def loop_leave_files(url=os.environ.get('LEAVE_FOLDER_URL'), latest_date=None):
+def discover_leave_sheets(url=os.environ.get('LEAVE_FOLDER_URL'), header=None):
+    '''
+    Lists the yearly workbooks in the leave folder and fetches the worksheets of every workbook from the current year on, in parallel.
 
-    header = generate_header()
+    Returns the index {"{Month}-{year}": worksheet url}, keyed like SpreadsheetManager.mmyy. Worksheets which are not named after a month are left out
+    '''
+    header = header or generate_header()
 
     drive_url = f"https://graph.microsoft.com/v1.0/drives/{os.environ.get('DRIVE_ID')}/items/"
 
     logging.info(url)
-    response = requests.get(url=url, headers=header)
+    response = graph.get(url=url, headers=header)
 
     # response.raise_for_status()
     if not 200 <= response.status_code < 300:
         logging.info("something went wrong when getting files")
         logging.info(response.text)
         raise AzureSyncError("Connection to Azure failed")
-    
-    months = []
+
+    current_year = current_sg_time().year
+    books = {}
 
     for value in response.json()['value']:
-        if value['name'].endswith(".xlsx"):
-            year = value['name'].split('.')[0]
-            year_int = int(year)
-            current_year = current_sg_time().year
-            if not year_int < current_year:
-                new_url = drive_url + value['id'] + '/workbook/worksheets'
-                logging.info(f"getting worksheets: {new_url}")
-                sheets_resp = requests.get(url=new_url, headers=header)
-                if not 200 <= sheets_resp.status_code < 300:
-                    logging.info("something went wrong when getting sheets")
-                    raise AzureSyncError("Connection to Azure failed")
-                for obj in sheets_resp.json()['value']:
-                    month = obj['name']
-                    month_int = int(datetime.strptime(month, "%B").month)
-                    if not latest_date:
-                        latest_date = current_sg_time()
-                    if not month_int < latest_date.month:
-                        months.append([month_int, year_int])
-                return months
-        else:
-            continue
+        year = value['name'].split('.')[0]
+        if value['name'].endswith(".xlsx") and year.isdigit() and not int(year) < current_year:
+            books[int(year)] = drive_url + value['id'] + '/workbook/worksheets'
 
-    return months
+    def get_worksheets(worksheets_url):
+        logging.info(f"getting worksheets: {worksheets_url}")
+        sheets_resp = graph.get(url=worksheets_url, headers=header)
+        if not 200 <= sheets_resp.status_code < 300:
+            logging.info("something went wrong when getting sheets")
+            raise AzureSyncError("Connection to Azure failed")
+        return sheets_resp.json()['value']
 
-def delay_decorator(message, seconds = 1, retries = 5):
-    def outer_wrapper(func):
-        def inner_wrapper(*args, **kwargs):
-            count = 0
-            while (count < retries):
+    index = {}
+
+    if len(books) == 0:
+        return index
+
+    with ThreadPoolExecutor(max_workers=min(GRAPH_MAX_CONNECTIONS, len(books))) as executor:
+        for (year, worksheets_url), sheets in zip(books.items(), executor.map(get_worksheets, books.values())):
+            for obj in sheets:
+                try:
+                    datetime.strptime(obj['name'], "%B")
+                except ValueError:
+                    continue
+                index[f"{obj['name']}-{year}"] = f"{worksheets_url}/{obj['id']}"
+
+    return index
+
+def cached_leave_sheet_index():
+    '''the cached index without discovering it on a miss, empty if there is none'''
+    cached = leave_sheets.get("index")
+    if cached:
+        try:
+            return json.loads(cached)
+        except json.JSONDecodeError:
+            leave_sheets.delete("index")
+    return {}
+
+def get_leave_sheet_index(url=os.environ.get('LEAVE_FOLDER_URL'), refresh=False):
+    '''discover_leave_sheets, reused for LEAVE_SHEETS_TTL by every process'''
+    index = {} if refresh else cached_leave_sheet_index()
+    if index:
+        return index
+
+    index = discover_leave_sheets(url)
+    leave_sheets.set("index", json.dumps(index))
+    return index
+
+def loop_leave_files(url=os.environ.get('LEAVE_FOLDER_URL'), latest_date=None):
+    '''returns [month, year] for every month worksheet in the leave folder from the month of latest_date on'''
+
+    if not latest_date:
+        latest_date = current_sg_time()
+
+    months = []
+
+    for mmyy in get_leave_sheet_index(url):
+        month_name, year = mmyy.split("-")
+        month_int = int(datetime.strptime(month_name, "%B").month)
+        if not (int(year), month_int) < (latest_date.year, latest_date.month):
+            months.append([month_int, int(year)])
+
+    return sorted(months, key=lambda mmyy: (mmyy[1], mmyy[0]))
+
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+NEW_WORKBOOK_RETRYABLE_STATUSES = RETRYABLE_STATUSES | {409} # a workbook which was just uploaded can still be locked for edits
+
+class RetryPolicy:
+    '''
+    Retries a Graph call with jittered exponential backoff.
+
+    A response is retried only if its status is in retryable_statuses, a connection error or timeout is retried unless retry_read_timeouts is False and the request may have reached Graph (see may_have_reached_graph). Calls which are not idempotent, eg. a POST adding rows, set it to False so that a slow response Graph did commit is not sent again. Retry-After is honoured when Graph sends it (429 and 503). No retry starts after deadline seconds from the first attempt, so a throttled endpoint cannot use up the cron minute
+    '''
+
+    def __init__(self, retries=5, base_delay=1, max_delay=20, deadline=30, retryable_statuses=RETRYABLE_STATUSES, retry_read_timeouts=True):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+        self.retryable_statuses = retryable_statuses
+        self.retry_read_timeouts = retry_read_timeouts
+
+    def backoff(self, attempt, retry_after=None):
+        '''seconds to wait before the next attempt, attempt starts at 0. retry_after is the Retry-After header if there was one'''
+        retry_after = parse_retry_after(retry_after)
+        if retry_after is not None:
+            return retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)) # full jitter
+
+    def call(self, func, message, endpoint, *args, **kwargs):
+        start = time.monotonic()
+        attempt = 0
+
+        while True:
+            response = error = None
+            try:
                 response = func(*args, **kwargs)
-                # logging.info(f"{response.status_code}, {response.text}")
                 if 200 <= response.status_code < 300:
                     return response
-                else:
-                    time.sleep(seconds)
-                count += 1
-            raise AzureSyncError(f"{message}. {response.text}")
+                retryable = response.status_code in self.retryable_statuses
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                error = e
+                retryable = self.retry_read_timeouts or not may_have_reached_graph(e)
+
+            reason = response.text if response is not None else repr(error)
+
+            if not retryable:
+                counters.incr(f"graph.failures.{endpoint}")
+                raise AzureSyncError(f"{message}. {reason}")
+
+            delay = self.backoff(attempt, response.headers.get('Retry-After') if response is not None else None)
+            attempt += 1
+            if attempt >= self.retries or time.monotonic() - start + delay > self.deadline:
+                counters.incr(f"graph.failures.{endpoint}")
+                raise AzureSyncError(f"{message}. {reason}")
+
+            counters.incr(f"graph.retries.{endpoint}")
+            logging.info(f"retrying {endpoint} in {delay:.2f}s after {response.status_code if response is not None else error}")
+            time.sleep(delay)
+
+def may_have_reached_graph(error):
+    '''
+    False only for the errors raised while connecting, before anything was sent: a connect timeout, or a connection error requests raises once urllib3 gave up connecting (MaxRetryError).
+
+    A read timeout, or a connection aborted after the request was written (ProtocolError), may come after Graph applied the request
+    '''
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return False
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args and isinstance(error.args[0], urllib3.exceptions.MaxRetryError):
+        return False
+    return True
+
+def parse_retry_after(value):
+    '''Retry-After is either a number of seconds or an HTTP date'''
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+def delay_decorator(message, seconds = 1, retries = 5, deadline = 30, retryable_statuses = RETRYABLE_STATUSES, retry_read_timeouts = True):
+    '''retries the decorated call, which returns a response, with a RetryPolicy. The retry counters are kept per decorated function, which wraps a single endpoint. Pass retry_read_timeouts = False if the call is not idempotent'''
+    policy = RetryPolicy(retries=retries, base_delay=seconds, deadline=deadline, retryable_statuses=retryable_statuses, retry_read_timeouts=retry_read_timeouts)
+
+    def outer_wrapper(func):
+        @wraps(func)
+        def inner_wrapper(*args, **kwargs):
+            return policy.call(func, message, func.__name__.lstrip('_'), *args, **kwargs)
             
         return inner_wrapper
-    return outer_wrapper
\ No newline at end of file
+    return outer_wrapper
+
+GRAPH_ROOT = "https://graph.microsoft.com/v1.0"
+GRAPH_BATCH_LIMIT = 20 # operations per $batch request allowed by Graph
+
+def graph_batch(operations, headers, message, sequential=True, policy=None):
+    '''
+    Sends operations, a list of (method, url, json body or None), as Graph $batch requests of up to GRAPH_BATCH_LIMIT operations. Returns the response of every operation, in order.
+
+    With sequential=True every operation dependsOn the one before it, so Graph runs them in order, eg. rows deleted by descending index. When an operation fails, the ones depending on it fail with 424 and are sent again with it in the next batch, following the RetryPolicy.
+
+    The $batch POST itself is only sent again if it never reached Graph. After a read timeout Graph may have run some of the operations already, and positional ones like DELETE rows/ItemAt(index=N) would then hit the wrong rows, so AzureSyncError is raised and the next sync's diff fixes the sheet. An operation missing from the responses is a failure which is not retried for the same reason
+    '''
+    policy = policy or RetryPolicy()
+
+    @delay_decorator(message, retry_read_timeouts = False)
+    def _post_batch(body):
+        return graph.post(url=f"{GRAPH_ROOT}/$batch", headers=headers, json=body)
+
+    results = [None] * len(operations)
+    pending = list(range(len(operations)))
+    start = time.monotonic()
+    attempt = 0
+
+    while pending:
+        chunk = pending[:GRAPH_BATCH_LIMIT]
+        batch_requests = []
+        for position, index in enumerate(chunk):
+            method, url, body = operations[index]
+            batch_request = {
+                "id": str(index),
+                "method": method,
+                "url": url[len(GRAPH_ROOT):] if url.startswith(GRAPH_ROOT) else url,
+            }
+            if body is not None:
+                batch_request["body"] = body
+                batch_request["headers"] = {"Content-Type": "application/json"}
+            if sequential and position > 0:
+                batch_request["dependsOn"] = [str(chunk[position - 1])]
+            batch_requests.append(batch_request)
+
+        counters.incr("graph.batch_operations", len(chunk))
+        try:
+            responses = {int(response["id"]): response for response in _post_batch({"requests": batch_requests}).json()["responses"]}
+        except (KeyError, ValueError):
+            counters.incr("graph.failures.batch")
+            raise AzureSyncError(f"{message}. Unexpected $batch response")
+
+        failed = []
+        for index in chunk:
+            response = responses.get(index)
+            if response is not None and 200 <= response.get("status", 0) < 300:
+                results[index] = response
+            else:
+                failed.append(index)
+
+        if not failed:
+            pending = pending[len(chunk):]
+            attempt = 0
+            continue
+
+        first_failure = responses.get(failed[0]) or {"status": None, "body": f"no response for operation {failed[0]}"}
+        retryable = all(index in responses and responses[index].get("status") in policy.retryable_statuses | {424} for index in failed)
+        failure_headers = {name.lower(): value for name, value in (first_failure.get("headers") or {}).items()}
+        delay = policy.backoff(attempt, failure_headers.get("retry-after"))
+        attempt += 1
+        if not retryable or attempt >= policy.retries or time.monotonic() - start + delay > policy.deadline:
+            counters.incr("graph.failures.batch")
+            raise AzureSyncError(f"{message}. {first_failure.get('body')}")
+
+        counters.incr("graph.retries.batch")
+        logging.info(f"retrying {len(failed)} batch operations in {delay:.2f}s after {first_failure['status']}")
+        time.sleep(delay)
+        pending = failed + pending[len(chunk):]
+
+    return results
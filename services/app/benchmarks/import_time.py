@@ -0,0 +1,90 @@
+'''
+Measures what python -X importtime loads for a minute where no task is due and for importing the app, and fails if a heavy module creeps back into either:
+
+    python -m benchmarks.import_time [--repeat 5] [--top 15]
+
+A no-op tasks.main may only import the standard library, tasks and constants. manage may import flask, SQLAlchemy and the models, but not the modules that are only needed by particular jobs (pandas, numpy, msal, elasticsearch, the spreadsheet manager). Importing manage needs the app's environment variables, as when running the app
+'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+APP_DIR = os.path.join(os.path.dirname(__file__), '..')
+
+# name, code run in a fresh interpreter, modules allowed outside the standard library (None for any), modules that must not be imported
+SCENARIOS = [
+    (
+        "tasks no-op minute",
+        "import tasks; tasks.main([])",
+        {"tasks", "constants"},
+        set(),
+    ),
+    (
+        "import manage",
+        "import manage",
+        None,
+        {"pandas", "numpy", "msal", "elasticsearch", "spacy", "azure.sheet_manager", "azure.token_provider", "es.manage", "es.file_extraction"},
+    ),
+]
+
+def run_importtime(code):
+    '''returns the wall time of the interpreter and {module: cumulative import us}'''
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=APP_DIR, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f"{code!r} failed:\n{result.stderr[-2000:]}")
+
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, _, cumulative, name = [part.strip() for part in line.replace("import time:", "|", 1).split("|")]
+        modules[name] = int(cumulative)
+    return elapsed, modules
+
+def check(modules, baseline, allowed, forbidden):
+    problems = []
+    if allowed is not None:
+        extra = sorted(
+            name for name in modules
+            if name not in baseline and name not in allowed
+            and name.split('.')[0] not in sys.stdlib_module_names and not name.startswith('_sysconfigdata') # loaded by sysconfig, named after the platform
+        )
+        if extra:
+            problems.append(f"outside the standard library: {', '.join(extra[:20])}{' ...' if len(extra) > 20 else ''}")
+    loaded = sorted(name for name in forbidden if name in modules)
+    if loaded:
+        problems.append(f"heavy modules loaded: {', '.join(loaded)}")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="slowest imports to list per scenario")
+    args = parser.parse_args()
+
+    failed = False
+    _, baseline = run_importtime("pass") # whatever site and sitecustomize load in every interpreter
+
+    for name, code, allowed, forbidden in SCENARIOS:
+        runs = [run_importtime(code) for _ in range(args.repeat)]
+        wall = statistics.median(elapsed for elapsed, _ in runs)
+        modules = runs[-1][1]
+
+        print(f"{name}: {wall * 1000:.0f} ms wall (median of {args.repeat}), {len(modules)} modules")
+        for module, cumulative in sorted(modules.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+            print(f"    {cumulative / 1000:8.1f} ms  {module}")
+
+        for problem in check(modules, baseline, allowed, forbidden):
+            failed = True
+            print(f"    REGRESSION: {problem}")
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+'''
+Times leave_classifier.classify against the intent check and leave type lookup it replaced, over the inbound message bodies.
+
+Uses the same corpus as benchmarks.leave_parser:
+
+    python -m benchmarks.leave_classifier [--dump ../../db_backup.sql] [--repeat 200]
+
+Every body is also checked to give the same intent and leave type through both paths
+'''
+
+import argparse
+import logging
+import os
+import re
+import time
+
+from constants import intents, leave_alt_words, leave_keywords, leave_types
+from models.jobs.user.utils_leave.classifier import leave_classifier
+from benchmarks.leave_parser import DEFAULT_DUMP, load_corpus_from_db, load_corpus_from_dump
+
+def legacy_classify(message):
+    '''MessageReceived.check_for_intent and JobLeave.set_leave_type as they were'''
+    intent = intents['ES_SEARCH']
+    if re.compile(leave_alt_words, re.IGNORECASE).search(message):
+        intent = intents['TAKE_LEAVE']
+
+    leave_type = None
+    leave_match = re.compile(leave_keywords, re.IGNORECASE).search(message)
+    if leave_match:
+        for _type, phrases in leave_types.items():
+            if leave_match.group(0).lower() in [phrase.lower() for phrase in phrases]:
+                leave_type = _type
+                break
+
+    return intent, leave_type
+
+def classify(message):
+    return leave_classifier.classify.__wrapped__(leave_classifier, message) # without the cache, every message is only seen once in production
+
+def run(func, corpus, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for message in corpus:
+            func(message)
+    return (time.perf_counter() - start) / (repeat * len(corpus))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dump", default=DEFAULT_DUMP)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+
+    if os.getenv("DATABASE_URL"):
+        corpus = load_corpus_from_db(os.environ["DATABASE_URL"])
+    else:
+        corpus = load_corpus_from_dump(args.dump)
+    print(f"corpus: {len(corpus)} messages")
+
+    mismatches = [message for message in corpus if legacy_classify(message) != classify(message)]
+    for message in mismatches[:10]:
+        print(f"mismatch: {message!r}\n    legacy: {legacy_classify(message)}\n    classifier: {classify(message)}")
+    print(f"mismatches: {len(mismatches)}")
+
+    legacy = run(legacy_classify, corpus, args.repeat)
+    classified = run(classify, corpus, args.repeat)
+    print(f"legacy:     {legacy * 1e6:.2f} us/message")
+    print(f"classifier: {classified * 1e6:.2f} us/message ({legacy / classified:.2f}x)")
+
+if __name__ == "__main__":
+    main()
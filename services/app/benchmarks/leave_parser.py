@@ -0,0 +1,115 @@
+'''
+Times LeaveMessageParser.parse against the separate extractors JobLeave.generate_base used to call, over the inbound message bodies.
+
+The corpus is read from the message table of DATABASE_URL if it is set, otherwise from the COPY block in db_backup.sql:
+
+    python -m benchmarks.leave_parser [--dump ../../db_backup.sql] [--repeat 20]
+
+Every body is also checked to give the same dates, duration and leave type through both paths
+'''
+
+import argparse
+import logging
+import os
+import re
+import time
+
+from constants import leave_keywords, leave_types
+from models.jobs.user.utils_leave import dates
+
+DEFAULT_DUMP = os.path.join(os.path.dirname(__file__), '..', '..', '..', 'db_backup.sql')
+
+LEGACY_DURATION_PATTERN = r'\b.*?' + dates.final_duration_extraction
+
+def load_corpus_from_db(database_url):
+    from sqlalchemy import create_engine, text
+
+    engine = create_engine(database_url)
+    with engine.connect() as conn:
+        return list(conn.execute(text("SELECT body FROM message WHERE type = 'message_received' AND body IS NOT NULL")).scalars())
+
+def load_corpus_from_dump(path):
+    '''reads the bodies of message_received rows from the tab separated COPY block of the message table'''
+    bodies = []
+    in_block = False
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.startswith('COPY public.message ('):
+                in_block = True
+                continue
+            if not in_block:
+                continue
+            if line.startswith('\\.'):
+                break
+            columns = line.rstrip('\n').split('\t')
+            if columns[1] == 'message_received' and columns[2] != '\\N':
+                bodies.append(columns[2].replace('\\n', '\n'))
+    return bodies
+
+def legacy_duration_extraction(message):
+    match_duration = re.compile(LEGACY_DURATION_PATTERN, re.IGNORECASE).search(message)
+    if match_duration:
+        return match_duration.group("duration1") or match_duration.group("duration2")
+    return None
+
+def legacy_parse(message):
+    '''the calls JobLeave.generate_base and set_leave_type made before LeaveMessageParser, with the duration pattern as it was. The other extractors use the precompiled patterns now, so for them this measures the repeated passes'''
+    duration = None
+    if legacy_duration_extraction(message):
+        duration = legacy_duration_extraction(message)
+        duration = 1 if duration.lower() == "a" else int(duration)
+
+    named_month_start, named_month_end = dates.named_month_extraction(message)
+    ddmm_start, ddmm_end = dates.named_ddmm_extraction(message)
+    day_start, day_end = dates.named_day_extraction(message)
+
+    start_dates = [date for date in [named_month_start, ddmm_start, day_start] if date is not None]
+    end_dates = [date for date in [named_month_end, ddmm_end, day_end] if date is not None]
+
+    leave_type = None
+    leave_match = re.compile(leave_keywords, re.IGNORECASE).search(message)
+    if leave_match:
+        for _type, phrases in leave_types.items():
+            if leave_match.group(0).lower() in [phrase.lower() for phrase in phrases]:
+                leave_type = _type
+                break
+
+    return (start_dates, end_dates, duration, leave_type)
+
+def parser_parse(message):
+    parsed = dates.leave_parser.parse(message)
+    return (parsed.start_dates, parsed.end_dates, parsed.duration, parsed.leave_type)
+
+def run(func, corpus, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for message in corpus:
+            func(message)
+    return (time.perf_counter() - start) / (repeat * len(corpus))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dump", default=DEFAULT_DUMP)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO) # the extractors log every step
+
+    if os.getenv("DATABASE_URL"):
+        corpus = load_corpus_from_db(os.environ["DATABASE_URL"])
+    else:
+        corpus = load_corpus_from_dump(args.dump)
+    print(f"corpus: {len(corpus)} messages")
+
+    mismatches = [message for message in corpus if legacy_parse(message) != parser_parse(message)]
+    for message in mismatches[:10]:
+        print(f"mismatch: {message!r}\n    legacy: {legacy_parse(message)}\n    parser: {parser_parse(message)}")
+    print(f"mismatches: {len(mismatches)}")
+
+    legacy = run(legacy_parse, corpus, args.repeat)
+    parsed = run(parser_parse, corpus, args.repeat)
+    print(f"legacy extractors: {legacy * 1e6:.1f} us/message")
+    print(f"leave_parser:      {parsed * 1e6:.1f} us/message ({legacy / parsed:.2f}x)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+'''
+Compares query plans for the hot lookups with and without the indexes from revision c4e1a7d2b3f0.
+
+Run against a database restored from db_backup.sql and upgraded to head:
+
+    psql $DATABASE_URL -f db_backup.sql && alembic upgrade head
+    python -m benchmarks.query_plans [--plans] [--repeat 50]
+
+The "before" pass drops the indexes inside a transaction which is rolled back afterwards, so the database is left untouched
+'''
+
+import argparse
+import json
+import os
+import time
+
+from sqlalchemy import create_engine, text
+
+INDEXES = [
+    'ix_message_job_no_seq_no',
+    'ix_message_confirm_ref_msg_sid',
+    'ix_job_created_at',
+    'ix_job_user_name',
+    'ix_job_unknown_from_no',
+    'ix_leave_records_job_no_date',
+    'ix_leave_records_date',
+    'ix_leave_records_date_active',
+]
+
+# name, statement, query returning the parameters sampled from the restored data
+QUERIES = [
+    (
+        "Message.get_seq_no",
+        "SELECT max(seq_no) FROM message WHERE job_no = :job_no",
+        "SELECT job_no FROM message WHERE job_no IS NOT NULL GROUP BY job_no ORDER BY count(*) DESC LIMIT 1",
+    ),
+    (
+        "Job.check_message_forwarded",
+        "SELECT * FROM message JOIN message_sent USING (sid) JOIN message_forward USING (sid) WHERE message.job_no = :job_no AND message.seq_no = :seq_no",
+        "SELECT m.job_no, m.seq_no FROM message m JOIN message_forward f USING (sid) LIMIT 1",
+    ),
+    (
+        "User.get_user",
+        "SELECT * FROM users WHERE number = :number LIMIT 1",
+        "SELECT number FROM users LIMIT 1",
+    ),
+    (
+        "MessageConfirm.check_for_other_decision",
+        "SELECT * FROM message_confirm WHERE ref_msg_sid = :ref_msg_sid",
+        "SELECT ref_msg_sid FROM message_confirm LIMIT 1",
+    ),
+    (
+        "JobUnknown.check_for_prev_job",
+        "SELECT * FROM job JOIN job_unknown USING (job_no) WHERE from_no = :from_no LIMIT 1",
+        "SELECT from_no FROM job_unknown LIMIT 1",
+    ),
+    (
+        "LeaveRecord.get_duplicates",
+        "SELECT leave_records.* FROM leave_records JOIN job_leave USING (job_no) JOIN job_user USING (job_no) "
+        "WHERE job_user.name = :name AND leave_records.date BETWEEN :start_date AND :end_date AND NOT leave_records.is_cancelled",
+        "SELECT ju.name, lr.date AS start_date, lr.date + 7 AS end_date FROM leave_records lr JOIN job_user ju USING (job_no) ORDER BY lr.date DESC LIMIT 1",
+    ),
+    (
+        "LeaveRecord.get_all_leaves_today",
+        "SELECT leave_records.date, users.name, users.dept FROM leave_records JOIN job_leave USING (job_no) JOIN job_user USING (job_no) "
+        "JOIN users ON job_user.name = users.name WHERE leave_records.date = :date AND NOT leave_records.is_cancelled",
+        "SELECT max(date) AS date FROM leave_records",
+    ),
+    (
+        "LeaveRecord.update_local_db",
+        "SELECT * FROM leave_records WHERE job_no = :job_no AND date >= :date AND NOT is_cancelled",
+        "SELECT job_no, min(date) AS date FROM leave_records GROUP BY job_no LIMIT 1",
+    ),
+    (
+        "JobSyncRecords.get_db_df",
+        "SELECT leave_records.id, leave_records.date FROM leave_records WHERE leave_records.date >= :date "
+        "AND extract(month FROM leave_records.date) = extract(month FROM CAST(:date AS date))",
+        "SELECT max(date) - 30 AS date FROM leave_records",
+    ),
+    (
+        "RetentionRun.run",
+        "SELECT created_at, job_no FROM job WHERE type = :type AND created_at < :threshold ORDER BY created_at, job_no LIMIT 500",
+        "SELECT 'job_acq_token' AS type, now() - interval '30 days' AS threshold",
+    ),
+]
+
+def sample_params(conn):
+    params = {}
+    for name, _, sample in QUERIES:
+        row = conn.execute(text(sample)).mappings().first()
+        params[name] = dict(row) if row else None
+    return params
+
+def measure(conn, params, repeat):
+    results = {}
+    for name, stmt, _ in QUERIES:
+        if params[name] is None:
+            continue
+        plan = conn.execute(text(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {stmt}"), params[name]).scalar()
+        plan = plan[0] if isinstance(plan, list) else json.loads(plan)[0]
+
+        start = time.perf_counter()
+        for _ in range(repeat):
+            conn.execute(text(stmt), params[name]).all()
+        elapsed = (time.perf_counter() - start) / repeat
+
+        results[name] = {
+            "plan": plan["Plan"],
+            "scans": sorted(set(scan_nodes(plan["Plan"]))),
+            "execution_ms": plan["Execution Time"],
+            "roundtrip_ms": elapsed * 1000,
+        }
+    return results
+
+def scan_nodes(node):
+    if "Scan" in node["Node Type"]:
+        yield f'{node["Node Type"]} on {node.get("Relation Name")}' + (f' using {node["Index Name"]}' if "Index Name" in node else "")
+    for child in node.get("Plans", []):
+        yield from scan_nodes(child)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--plans", action="store_true", help="print the full plans")
+    args = parser.parse_args()
+
+    engine = create_engine(os.environ["DATABASE_URL"])
+
+    with engine.connect() as conn:
+        existing = set(conn.execute(text("SELECT indexname FROM pg_indexes WHERE indexname = ANY(:names)"), {"names": INDEXES}).scalars())
+        missing = [index for index in INDEXES if index not in existing]
+        if missing:
+            print(f"warning: {', '.join(missing)} missing, run alembic upgrade head first")
+
+        params = sample_params(conn)
+        conn.commit()
+
+        with conn.begin() as trans:
+            for index in existing:
+                conn.execute(text(f"DROP INDEX {index}"))
+            conn.execute(text("ANALYZE"))
+            before = measure(conn, params, args.repeat)
+            trans.rollback()
+
+        conn.execute(text("ANALYZE"))
+        conn.commit()
+        after = measure(conn, params, args.repeat)
+
+    print(f"{'query':42} {'before ms':>10} {'after ms':>10} {'roundtrip before':>17} {'roundtrip after':>16}")
+    for name in after:
+        print(f"{name:42} {before[name]['execution_ms']:>10.3f} {after[name]['execution_ms']:>10.3f} "
+              f"{before[name]['roundtrip_ms']:>17.3f} {after[name]['roundtrip_ms']:>16.3f}")
+        print(f"    before: {'; '.join(before[name]['scans'])}")
+        print(f"    after:  {'; '.join(after[name]['scans'])}")
+        if args.plans:
+            print(json.dumps({"before": before[name]["plan"], "after": after[name]["plan"]}, indent=2, default=str))
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,15 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 class Config:
     SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL")
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SQLALCHEMY_POOL_SIZE = 10
-    SQLALCHEMY_MAX_OVERFLOW = 20
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_size": 10,
+        "max_overflow": 20,
+        "pool_pre_ping": True
+    }
     REDIS_URL = os.getenv("REDIS_URL")
     FERNET_KEY = os.getenv("FERNET_KEY")
+    ASYNC_USER_JOBS = os.getenv("ASYNC_USER_JOBS") == "1" # webhook only enqueues, worker.py runs the jobs
+    ASYNC_CALLBACKS = os.getenv("ASYNC_CALLBACKS") == "1" # callback endpoint only appends to a stream, worker.py applies them
 
 account_sid = os.environ.get('TWILIO_ACCOUNT_SID')
 auth_token = os.environ.get('TWILIO_AUTH_TOKEN')
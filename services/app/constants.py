@@ -1,4 +1,7 @@
 MAX_UNBLOCK_WAIT = 30
+FORWARD_MAX_WORKERS = 8 # concurrent Twilio requests per forward fan out
+TWILIO_MAX_MPS = 10 # messages per second across all fan outs of the process, keep within the messaging service throughput
+LEAVE_FULL_SYNC_HOURS = 6 # JobSyncRecords only pushes the leave_record_changes outbox in between full reconciliations
 
 # OTHER STATUSES. Use 2^n to get unique values
 NONE = 0
@@ -37,6 +40,13 @@ DOUBLE_MESSAGE = 409 # Conflict This will always be a job with a single message
 #     "OK": OK
 # } # → Processing, Pending User Reply, Accepted (Db), Ok (Forwards)
 
+# Twilio message statuses handled by Job.update_with_msg_callback, in the order they can arrive
+CALLBACK_STATUS_RANK = {
+    "sent": 1,
+    "delivered": 2,
+    "failed": 3
+}
+
 DECISIONS = {
     'CONFIRM': '1',
     'CANCEL': '2',
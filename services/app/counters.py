@@ -0,0 +1,41 @@
+import threading
+import time
+from contextlib import contextmanager
+
+class Counters:
+    '''In-process counters and timings. Every gunicorn worker, worker.py and tasks.py keeps its own set, exposed at /chatbot/counters/ for the web workers'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {}
+        self._timings = {}
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + amount
+
+    def observe(self, name, value):
+        '''records a measurement, eg. seconds spent waiting or commits per message'''
+        with self._lock:
+            timing = self._timings.setdefault(name, {"count": 0, "total": 0, "max": 0})
+            timing["count"] += 1
+            timing["total"] += value
+            timing["max"] = max(timing["max"], value)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start)
+
+    def snapshot(self):
+        with self._lock:
+            timings = {
+                name: dict(timing, avg=timing["total"] / timing["count"])
+                for name, timing in self._timings.items()
+            }
+            return {"counts": dict(self._counts), "timings": timings}
+
+counters = Counters()
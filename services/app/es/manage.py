@@ -3,7 +3,7 @@ from elasticsearch import Elasticsearch, NotFoundError
 from ._settings import index_body
 from .file_extraction import read_pdf, read_word, read_txt
 from azure.utils import generate_header
-import requests
+from azure.graph import graph
 import os
 import json
 import re
@@ -141,7 +141,7 @@ def loop_through_files(url, fileobj=None):
 
     headers = generate_header()
 
-    response = requests.get(url=url, headers=headers)
+    response = graph.get(url=url, headers=headers)
     # response.raise_for_status()
     if not 200 <= response.status_code < 300:
         logger.info("something went wrong when getting files")
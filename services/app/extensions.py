@@ -1,14 +1,44 @@
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy import event
+from sqlalchemy.orm import scoped_session, sessionmaker, Session
 from flask import has_request_context, current_app
 import logging
+import threading
 
 db = SQLAlchemy()
 
 ThreadSession = None
 
+_commits = threading.local()
+
+@event.listens_for(Session, "after_commit")
+def _count_commit(session):
+    _commits.count = getattr(_commits, "count", 0) + 1
+
+def commit_count():
+    '''commits made by the current thread so far, compare before and after a unit of work'''
+    return getattr(_commits, "count", 0)
+
+@event.listens_for(Session, "after_transaction_end")
+def _release_job_row(session, transaction):
+    if transaction.parent is None: # the outermost transaction, a savepoint ending keeps the row lock
+        session.info.pop("locked_job_no", None)
+
+def hold_job_row(session, job_no):
+    '''records that the transaction of session holds the row lock of job_no until it ends, see Message.next_seq_no'''
+    session.info["locked_job_no"] = job_no
+
+def check_no_job_row_held(session):
+    '''raises if session still holds a job row locked by Message.next_seq_no, a Twilio or Graph request made before the commit would keep every other writer of the job waiting'''
+    job_no = session.info.get("locked_job_no")
+    if job_no is not None:
+        raise RuntimeError(f"job {job_no} is locked by Message.next_seq_no, commit before making external requests")
+
 def init_thread_session(engine):
     global ThreadSession
+    # replacing the registry would orphan the sessions other threads are still using
+    if ThreadSession is not None and ThreadSession.session_factory.kw.get('bind') is engine:
+        return
     ThreadSession = scoped_session(sessionmaker(bind=engine))
 
 def remove_thread_session():
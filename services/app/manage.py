@@ -1,7 +1,8 @@
 from flask import Flask
 from extensions import db, init_thread_session
 from config import Config, twilio_client
-from sqlalchemy import create_engine
+from counters import counters
+import threading
 
 from models.users import User
 from models.messages.sent import MessageSent, MessageForward
@@ -25,14 +26,41 @@ import hashlib
 import os
 from redis_client import Redis
 
+_app = None
+_app_lock = threading.Lock()
+
+def get_app():
+    '''Returns the app of this process, creating it on first use. Background threads, tasks.py and worker.py share its engine and Redis pool instead of opening new ones'''
+    global _app
+    if _app is None:
+        with _app_lock:
+            if _app is None:
+                _app = create_app()
+    return _app
+
+def registry_stats():
+    '''How many apps and Redis pools this process has created, with the state of the shared DB pool'''
+    snapshot = counters.snapshot()['counts']
+    stats = {
+        "apps": snapshot.get("registry.apps_created", 0),
+        "redis_pools": snapshot.get("registry.redis_pools_created", 0),
+    }
+    if _app is not None:
+        with _app.app_context():
+            stats["db_pool"] = db.engine.pool.status()
+    return stats
+
 def create_app():
     app = Flask(__name__)
     app.config.from_object(Config)
 
     # Bind extensions to the app
     db.init_app(app)
+    counters.incr("registry.apps_created")
 
-    engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI']) # set echo = True if want to debug
+    # background threads use the same engine (and connection pool) as the request sessions
+    with app.app_context():
+        engine = db.engine # set echo = True in SQLALCHEMY_ENGINE_OPTIONS if want to debug
     init_thread_session(engine)
 
     # Fernet encryption key setup
@@ -40,7 +68,7 @@ def create_app():
     cipher_suite = Fernet(FERNET_KEY)
 
     # Redis client setup 
-    redis_client = Redis(app.config['REDIS_URL'], cipher_suite)
+    redis_client = Redis(app.config['REDIS_URL'], cipher_suite, async_jobs=app.config['ASYNC_USER_JOBS'], async_callbacks=app.config['ASYNC_CALLBACKS'])
 
     # Utility function setup
     def hash_identifier(identifier, salt=''):
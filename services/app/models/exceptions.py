@@ -28,6 +28,13 @@ class AzureSyncError(Exception):
         self.message = message
         super().__init__(self.message)
 
+class LockTimeoutError(Exception):
+    """throws error when a distributed lock could not be acquired in time"""
+
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
 def handle_value_error(ex):
     logging.error("ValueError encountered.")
 
@@ -2,7 +2,7 @@ from extensions import db, get_session, remove_thread_session
 from sqlalchemy import inspect
 import shortuuid
 import logging
-from constants import PROCESSING, OK, SERVER_ERROR, messages, CLIENT_ERROR, PENDING_CALLBACK, errors
+from constants import PROCESSING, OK, SERVER_ERROR, messages, CLIENT_ERROR, PENDING_CALLBACK, PENDING_USER_REPLY, errors
 from utilities import current_sg_time, join_with_commas_and, log_instances
 import json
 import os
@@ -20,6 +20,12 @@ from models.messages.received import MessageConfirm
 
 from functools import wraps
 
+# follow ups handed off by callers which must not wait for them, eg. the callback applier in worker.py
+background_pool = ThreadPoolExecutor(max_workers=5)
+
+# the callback statuses update_with_msg_callbacks acts on, only these are stashed for a message which is not committed yet. Others, eg. queued or sent, or those of outbound messages which are not forwards, would sit in the stash until it expires
+EARLY_CALLBACK_STATUSES = {"delivered", "failed"}
+
 class Job(db.Model): # system jobs
 
     logger = setup_logger('models.job')
@@ -29,8 +35,9 @@ class Job(db.Model): # system jobs
     job_no = db.Column(db.String, primary_key=True)
     type = db.Column(db.String(50))
     status = db.Column(db.Integer(), nullable=False)
-    created_at = db.Column(db.DateTime(timezone=True))
-    locked = db.Column(db.Boolean(), nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), index=True)
+    locked = db.Column(db.Boolean(), nullable=False) # unused since background tasks lock through Redis, see run_new_context
+    last_seq_no = db.Column(db.Integer(), nullable=False, default=0, server_default='0') # incremented by Message.next_seq_no
     
     __mapper_args__ = {
         "polymorphic_identity": "job",
@@ -44,22 +51,15 @@ class Job(db.Model): # system jobs
         self.created_at = current_sg_time()
         self.status = PROCESSING
         self.locked = False
+        self.last_seq_no = 0
 
-    def unlock(self, session):
-        self.locked = False
-        session.commit()
-
-    def lock(self, session):
-        self.locked = True
-        session.commit()
-
-    # BUG
     @staticmethod
-    def run_new_context(wait_time=None):
+    def run_new_context(wait_time=None, lock_ttl=120, lock_timeout=60):
+        '''Runs the method in a new app context while holding the job's Redis lock, so only one background task works on a job at a time'''
         def decorator(func):
             @wraps(func)
             def wrapper(self, *args, **kwargs):
-                from manage import create_app
+                from manage import get_app
 
                 result = None
 
@@ -73,29 +73,19 @@ class Job(db.Model): # system jobs
                 if wait_time:
                     time.sleep(wait_time)
 
-                app = create_app()
+                app = get_app()
                 with app.app_context():
                     session = get_session()
                     logging.info("In decorator")
 
                     try:
-                        for _ in range(300):
+                        with app.redis_client.lock(f"job:{self.job_no}", ttl=lock_ttl, timeout=lock_timeout):
+                            logging.info(f"lock acquired for job {self.job_no}")
                             updated_job = session.query(Job).filter_by(job_no = self.job_no).first()
-                            if not updated_job.locked:
-                                break
-                        if not updated_job.locked:
                             log_instances(session, "run_new_context")
-                            updated_job.lock(session)
-                            session.commit()
-                        else:
-                            raise Exception                            
 
-                        logging.info(id(session))
-                        result = func(updated_job, *args, **kwargs)
-
-                    
-                        if isinstance(updated_job, Job):
-                            updated_job.unlock(session)
+                            logging.info(id(session))
+                            result = func(updated_job, *args, **kwargs)
 
                         logging.info(f"Result in decorator: {result}")
 
@@ -172,10 +162,7 @@ class Job(db.Model): # system jobs
             self.forwards_status = status
         session.commit()
 
-        job2 = session.query(Job).filter_by(job_no=self.job_no).first()
-        logging.info(f"job no: {job2.job_no}")
-
-        logging.info(f"Status in commit status: {job2.status if not _forwards else job2.forwards_status}, status passed: {status}")
+        logging.info(f"Status in commit status for job {self.job_no}: {status}")
 
         return
 
@@ -294,7 +281,182 @@ class Job(db.Model): # system jobs
                 Message.send_msg(messages['SENT'], (os.environ.get("ERROR_SID"), None), self)
 
         return None
-    
+
+    @staticmethod
+    def update_with_msg_callbacks(callbacks):
+        '''
+        Batched version of update_with_msg_callback, used by the callback applier in worker.py.
+
+        callbacks maps each sid to its coalesced callback, see Redis.coalesce_callbacks. The status changes of the whole batch are committed in a single transaction, then the follow ups run once per job instead of once per callback. Job completion is checked here, the forward checks and the message bodies are left to background_pool.
+
+        Returns a list of (to_no, message) for messages which are now pending a user reply
+        '''
+
+        from models.messages.abstract import Message
+
+        session = get_session()
+
+        msgs = session.query(MessageSent).filter(
+            MessageSent.sid.in_(list(callbacks.keys()))
+        ).all()
+
+        missing_sids = set(callbacks.keys()) - {message.sid for message in msgs}
+        if missing_sids: # not committed yet, replayed by forward_template_msges
+            Job.stash_early_callbacks({sid: callbacks[sid] for sid in missing_sids})
+
+        pending_msgs = [message for message in msgs if message.status == PENDING_CALLBACK]
+
+        delivered = []
+        failed = []
+        bodies_to_fetch = []
+
+        for message in pending_msgs:
+            callback = callbacks[message.sid]
+            status = callback['status']
+
+            if callback['sent'] and message.body is None:
+                bodies_to_fetch.append(message.sid)
+
+            if status == "delivered":
+                message.status = OK
+                delivered.append(message)
+            elif status == "failed":
+                message.status = SERVER_ERROR
+                failed.append(message)
+
+        session.commit()
+        logging.info(f"callback batch applied: {len(pending_msgs)} messages, {len(delivered)} delivered, {len(failed)} failed")
+
+        messages_pending_reply = []
+        forwards_to_check = {}
+        jobs_to_complete = {}
+
+        for message in delivered:
+            job = message.job
+            if message.is_expecting_reply == True: # update redis
+                messages_pending_reply.append((callbacks[message.sid]['to'], message))
+                continue
+            if message.type == "message_forward" and job.forward_status_not_null():
+                forwards_to_check[(job.job_no, message.seq_no)] = job
+            jobs_to_complete[job.job_no] = job
+
+        for message in failed:
+            job = message.job
+            if message.type == "message_forward" and job.forward_status_not_null():
+                forwards_to_check[(job.job_no, message.seq_no)] = job
+            else:
+                job.commit_status(SERVER_ERROR)
+
+            if job.type == "job_es":
+                Message.send_msg(messages['SENT'], (os.environ.get("ERROR_SID"), None), job)
+
+        # check_message_forwarded waits 5s for the rest of the callbacks, and fetching the bodies is a Twilio request each, so neither holds up the batch
+        for (job_no, seq_no), job in forwards_to_check.items():
+            background_pool.submit(Job.check_message_forwarded_by_job_no, job_no, seq_no, job.map_job_type())
+
+        if bodies_to_fetch:
+            background_pool.submit(Job.fetch_message_bodies, bodies_to_fetch)
+
+        for job in jobs_to_complete.values():
+            job.check_for_complete()
+
+        return messages_pending_reply
+
+    @staticmethod
+    def check_message_forwarded_by_job_no(job_no, seq_no, _type):
+        '''check_message_forwarded for a job the caller only knows the job_no of, the ORM object stays in the caller's session'''
+        from manage import get_app
+
+        with get_app().app_context():
+            try:
+                job = get_session().get(Job, job_no)
+                if job:
+                    job.check_message_forwarded(seq_no, _type)
+            except Exception:
+                logging.error(traceback.format_exc())
+            finally:
+                remove_thread_session()
+
+    @staticmethod
+    def fetch_message_bodies(sids):
+        '''fills in the bodies of sent template messages from Twilio, which only has them once they are sent'''
+        from manage import get_app
+        from models.messages.abstract import Message
+
+        with get_app().app_context():
+            session = get_session()
+            try:
+                for message in session.query(MessageSent).filter(MessageSent.sid.in_(sids), MessageSent.body.is_(None)).all():
+                    message.body = Message.fetch_message(message.sid)
+                session.commit()
+            except Exception:
+                session.rollback()
+                logging.error(traceback.format_exc())
+            finally:
+                remove_thread_session()
+
+    @staticmethod
+    def stash_early_callbacks(callbacks):
+        '''
+        Stashes coalesced callbacks whose messages are not committed yet, for forward_template_msges to pop once it commits its forwards. Only the statuses in EARLY_CALLBACK_STATUSES are stashed.
+
+        The forwards may have been committed and popped between the caller's lookup and the stash, which would leave the stash to expire, so the sids are looked up again afterwards and the stash of those now committed is popped and replayed
+        '''
+        from flask import current_app
+
+        callbacks = {sid: callback for sid, callback in callbacks.items() if callback['status'] in EARLY_CALLBACK_STATUSES}
+        if not callbacks:
+            return
+
+        redis_client = current_app.redis_client
+        for sid, callback in callbacks.items():
+            if callback['sent'] and callback['status'] != "sent":
+                redis_client.stash_early_callback(sid, "sent", callback['to'])
+            redis_client.stash_early_callback(sid, callback['status'], callback['to'])
+
+        session = get_session()
+        committed = session.query(MessageSent.sid).filter(MessageSent.sid.in_(list(callbacks.keys()))).all()
+        if committed:
+            Job.replay_callbacks(redis_client.pop_early_callbacks([row.sid for row in committed]))
+
+    @staticmethod
+    def replay_callbacks(events):
+        '''hands callbacks popped from the early stash back to be applied without blocking the caller, through the callback stream when worker.py applies callbacks, otherwise on a thread of their own'''
+        from flask import current_app
+
+        if not events:
+            return
+
+        redis_client = current_app.redis_client
+        if redis_client.async_callbacks:
+            for _, event in events:
+                redis_client.add_callback_event(event['sid'], event['status'], event['to'])
+        else:
+            threading.Thread(target=Job.apply_msg_callbacks_in_new_context, args=(redis_client.coalesce_callbacks(events),), daemon=True).start()
+
+    @staticmethod
+    def apply_msg_callbacks_in_new_context(callbacks):
+        from manage import get_app
+
+        app = get_app()
+        with app.app_context():
+            try:
+                Job.apply_msg_callbacks(callbacks)
+            except Exception:
+                logging.error(traceback.format_exc())
+            finally:
+                remove_thread_session()
+
+    @staticmethod
+    def apply_msg_callbacks(callbacks):
+        '''applies a batch of coalesced callbacks and hands the messages now pending a user reply to Redis'''
+        from flask import current_app
+
+        for to_no, message in Job.update_with_msg_callbacks(callbacks):
+            encoded_no = current_app.hash_identifier(str(to_no))
+            current_app.redis_client.update_job_status(encoded_no, message)
+            message.job.commit_status(PENDING_USER_REPLY)
+
     def map_job_type(self):
         from models.jobs.user.leave import JobLeave, JobLeaveCancel
         from models.jobs.system.abstract import JobSystem
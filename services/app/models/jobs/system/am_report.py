@@ -8,7 +8,6 @@ from logs.config import setup_logger
 from constants import OK
 
 import os
-import pandas as pd
 import requests
 from utilities import current_sg_time
 from models.users import User
@@ -117,6 +116,7 @@ class JobAmReport(JobSystem):
             self.logger.info(f"cv and users list: {self.cv_and_users_list}")
     
     def main(self):
+        import pandas as pd
 
         try:
             all_records_today = LeaveRecord.get_all_leaves_today()
@@ -1,5 +1,4 @@
 from sqlalchemy import select, func, extract, cast, Integer
-from azure.sheet_manager import SpreadsheetManager
 import requests
 from utilities import current_sg_time
 from datetime import datetime, timedelta
@@ -7,15 +6,18 @@ from azure.utils import loop_leave_files, generate_header
 from models.jobs.system.abstract import JobSystem
 from logs.config import setup_logger
 from extensions import db, get_session
-import pandas as pd
 from models.exceptions import AzureSyncError, ReplyError
-from constants import messages, intents, OK, SERVER_ERROR, PROCESSING
+from constants import messages, intents, OK, SERVER_ERROR, PROCESSING, LEAVE_FULL_SYNC_HOURS
 import os
 from constants import metric_names
 import traceback
 from utilities import print_all_dates
 from models.users import User
+from counters import counters
 import json
+from concurrent.futures import ThreadPoolExecutor
+
+SYNC_MONTHS_MAX_WORKERS = int(os.getenv("SYNC_MONTHS_MAX_WORKERS", 3)) # months read and pushed at the same time, 1 syncs them one after another
 
 class JobSyncRecords(JobSystem):
 
@@ -25,6 +27,7 @@ class JobSyncRecords(JobSystem):
 
     job_no = db.Column(db.ForeignKey("job_system.job_no", ondelete='CASCADE'), primary_key=True)
     forwards_status = db.Column(db.Integer, default=None, nullable=True)
+    is_full_sync = db.Column(db.Boolean, nullable=False, default=False, server_default='false')
     
     __mapper_args__ = {
         "polymorphic_identity": "job_sync_records",
@@ -33,11 +36,8 @@ class JobSyncRecords(JobSystem):
     def __init__(self):
         super().__init__() # admin name is default
         self.header = generate_header()
-        self.cur_az_df = None
-        self.cur_db_df = None
         self.start_time = current_sg_time()
         self.latest_date = self.start_time.date() - timedelta(days=1)
-        self.cur_manager = None
         self.content_sid = os.environ.get('SHAREPOINT_LEAVE_SYNC_NOTIFY_SID')
         self.records = {
             intents['SHAREPOINT_ADD_RECORD']: {SERVER_ERROR: {}, OK: {}},
@@ -45,17 +45,20 @@ class JobSyncRecords(JobSystem):
         }
         self.cv_and_users_list = []
         self.content_sid = os.environ.get('SHAREPOINT_LEAVE_SYNC_NOTIFY_SID')
+        self.is_full_sync = False
+        self.all_missing_job_names = {}
 
-    def get_az_df(self):
-        az_df = self.cur_manager.find_all_dates()
+    def get_az_df(self, manager):
+        az_df = manager.find_all_dates()
         mask = ((az_df["date"] >= self.latest_date) | (az_df.isna().any(axis=1)))
-        self.cur_az_df = az_df.loc[mask]
         self.logger.info("printing az dtypes")
-        # self.logger.info(self.cur_az_df.dtypes)
-        # self.logger.info(self.cur_az_df.info())
-        # self.logger.info(self.cur_az_df)
+        # self.logger.info(az_df.dtypes)
+        # self.logger.info(az_df.info())
+        # self.logger.info(az_df)
+        return az_df.loc[mask]
 
     def get_db_df(self, mm, yy):
+        import pandas as pd
         from models.jobs.user.leave import JobLeave
         from models.leave_records import LeaveRecord
         from models.users import User
@@ -68,7 +71,7 @@ class JobSyncRecords(JobSystem):
             User.name,
             User.dept,
             JobLeave.leave_type,
-            JobLeave.is_cancelled,
+            LeaveRecord.is_cancelled,
             LeaveRecord.sync_status
         ).join(
             LeaveRecord, JobLeave.job_no == LeaveRecord.job_no
@@ -84,7 +87,7 @@ class JobSyncRecords(JobSystem):
         # self.logger.info("printing db dtypes")
         # self.logger.info(db_df.info())
         # self.logger.info(db_df.dtypes)
-        self.cur_db_df = db_df
+        return db_df
 
     def get_all_mmyy_in_db(self):
         from models.leave_records import LeaveRecord
@@ -106,6 +109,67 @@ class JobSyncRecords(JobSystem):
 
         return [[month, year] for month, year in results]
     
+    def full_sync_due(self):
+        '''a full reconciliation also picks up edits made directly in Sharepoint, so it still runs every LEAVE_FULL_SYNC_HOURS, and until one has succeeded'''
+        session = get_session()
+        last_full_sync = session.query(func.max(JobSyncRecords.created_at)).filter(
+            JobSyncRecords.is_full_sync == True,
+            JobSyncRecords.status == OK
+        ).scalar()
+
+        return not last_full_sync or self.start_time - last_full_sync >= timedelta(hours=LEAVE_FULL_SYNC_HOURS)
+
+    def get_pending_changes(self):
+        '''returns the unprocessed leave_record_changes with the record details format_row needs, oldest first'''
+        import pandas as pd
+        from models.jobs.user.leave import JobLeave
+        from models.leave_records import LeaveRecord, LeaveRecordChange
+
+        session = get_session()
+
+        rows = session.query(
+            LeaveRecordChange.id,
+            LeaveRecordChange.action,
+            LeaveRecord.id,
+            LeaveRecord.date,
+            User.name,
+            User.dept,
+            JobLeave.leave_type,
+            LeaveRecord.is_cancelled,
+            LeaveRecord.sync_status
+        ).join(
+            LeaveRecord, LeaveRecordChange.record_id == LeaveRecord.id
+        ).join(
+            JobLeave, JobLeave.job_no == LeaveRecord.job_no
+        ).join(
+            User, JobLeave.name == User.name
+        ).filter(
+            LeaveRecordChange.processed_at == None
+        ).order_by(LeaveRecordChange.id).all()
+
+        return pd.DataFrame(rows, columns=['change_id', 'action', 'record_id', 'date', 'name', 'dept', 'leave_type', 'is_cancelled', 'sync_status'])
+
+    def mark_changes_processed(self, change_ids):
+        from models.leave_records import LeaveRecordChange
+
+        if len(change_ids) == 0:
+            return
+
+        session = get_session()
+        session.query(LeaveRecordChange).filter(
+            LeaveRecordChange.id.in_(change_ids)
+        ).update({"processed_at": current_sg_time()}, synchronize_session=False)
+
+    def set_sync_status(self, action, status, record_ids, name):
+        from models.leave_records import LeaveRecord
+
+        session = get_session()
+        for id in record_ids:
+            record = session.query(LeaveRecord).filter_by(id=id).first()
+            if record and record.sync_status != status:
+                record.sync_status = status
+                self.update_records(action, status, name, record.date)
+
     def update_records(self, type, status, name, date):
         self.logger.info(f"type: {type}, status: {status}, name: {name}, date: {date}")
         if name not in self.records[type][status]:
@@ -143,150 +207,272 @@ class JobSyncRecords(JobSystem):
     
 
     def main(self):
-        from models.leave_records import LeaveRecord
         from models.messages.sent import MessageForward
 
+        self.is_full_sync = self.full_sync_due()
+
+        if self.is_full_sync:
+            counters.incr("sync_leave_records.full")
+            self.full_sync()
+        else:
+            counters.incr("sync_leave_records.incremental")
+            self.incremental_sync()
+
+        if any(records for all_action_records in self.records.values() for records in all_action_records.values()):
+            self.logger.info("sending messages")
+            self.logger.info(f"records of new leaves: {self.records}")
+            self.get_sharepoint_leave_sync_notify_cv()
+            self.logger.info(f"content variables: {self.cv_and_users_list}")
+            MessageForward.forward_template_msges(self)
+        elif not self.error and len(self.all_missing_job_names) == 0:
+            self.commit_status(OK, _forwards=True)
+            self.reply = "Nothing to sync"
+            return
+
+        if self.error == True:
+            self.reply = "Error connecting to Azure"
+        else:
+            self.reply = "Sync was successful"
+
+            if len(self.all_missing_job_names) > 0:
+                names_dates_str = '; '.join(f"{name}: {print_all_dates(date_list, date_obj=True)}" for name, date_list in self.all_missing_job_names.items())
+                self.reply += f". Also, unmatched records were found in Azure: {names_dates_str}"
+
+    def sync_months(self, push_month, months):
+        '''
+        Runs push_month(mm, yy, *args) for each (mm, yy, *args) in months on up to SYNC_MONTHS_MAX_WORKERS threads, and yields the results in order as they come back.
+
+        push_month must only make Graph calls, the database reads are done beforehand and the writeback by the caller, so the session stays on this thread. Months of the same book may create it or add worksheets at the same time, SpreadsheetManager.table_url serialises that per year. A month that raises is re-raised after the other months have been yielded
+        '''
+        if len(months) == 0:
+            return
+
+        error = None
+        with ThreadPoolExecutor(max_workers=min(SYNC_MONTHS_MAX_WORKERS, len(months))) as executor:
+            futures = [executor.submit(push_month, *month) for month in months]
+
+            for future in futures:
+                try:
+                    yield future.result()
+                except Exception as e:
+                    self.logger.error(traceback.format_exc())
+                    error = error or e
+
+        if error:
+            raise error
+
+    def push_changes_month(self, mm, yy, month_df):
+        from azure.sheet_manager import SpreadsheetManager
+
+        manager = SpreadsheetManager(mmyy=[mm, yy])
+
+        dates_to_del = month_df.loc[month_df.is_cancelled == True]
+        dates_to_update = month_df.loc[month_df.is_cancelled == False]
+        del_status = add_status = None
+
+        # the table is read for the adds too: a record can already be in it, eg. an upload that timed out after Graph applied it, or a change logged while a full sync was reading the month, and appending it again would duplicate the row
+        try:
+            az_df = manager.find_all_dates()
+        except AzureSyncError as e:
+            self.logger.error(e.message)
+            return dates_to_del, None if dates_to_del.empty else SERVER_ERROR, dates_to_update, None if dates_to_update.empty else SERVER_ERROR
+        az_record_ids = az_df.record_id.astype(str)
+
+        if not dates_to_del.empty:
+            try:
+                indexes_to_rm = az_df.loc[az_record_ids.isin(dates_to_del.record_id.astype(str)), "az_index"].astype(int).tolist()
+                self.logger.info(f"indexes to remove: {indexes_to_rm}")
+                if indexes_to_rm:
+                    manager.delete_from_excel(indexes_to_rm)
+                del_status = OK
+            except AzureSyncError as e:
+                del_status = SERVER_ERROR
+                self.logger.error(e.message)
+
+        if not dates_to_update.empty:
+            dates_to_add = dates_to_update.loc[~dates_to_update.record_id.astype(str).isin(az_record_ids)]
+            self.logger.info(f"{dates_to_update.shape[0] - dates_to_add.shape[0]} records already in the table")
+            try:
+                if not dates_to_add.empty:
+                    manager.upload_data(list(dates_to_add.apply(self.format_row, axis=1)))
+                add_status = OK
+            except AzureSyncError as e:
+                add_status = SERVER_ERROR
+                self.logger.error(e.message)
+
+        return dates_to_del, del_status, dates_to_update, add_status
+
+    def incremental_sync(self):
+        '''
+        Pushes only the pending leave_record_changes, so a run without changes makes no Graph calls.
+
+        Changes are coalesced per record and the record's current state is pushed against that month's table: rows are appended for active records not in it yet, and removed for cancelled ones. A cancelled record whose ADD is still pending never reached Sharepoint and is skipped. Changes stay pending until their push succeeds
+        '''
         session = get_session()
 
-        self.az_mmyy_arr = loop_leave_files(latest_date=self.latest_date)
-        # self.logger.info(self.az_mmyy_arr)
-        self.db_mmyy_arr = self.get_all_mmyy_in_db()
-        # self.logger.info(self.db_mmyy_arr)
+        changes_df = self.get_pending_changes()
+        self.logger.info(f"pending changes: {changes_df.shape[0]}")
+        if changes_df.empty:
+            return
 
-        db_mmyy_set = set(tuple(mmyy) for mmyy in self.db_mmyy_arr)
-        az_mmyy_set = set(tuple(mmyy) for mmyy in self.az_mmyy_arr)
-        combined_mmyy_set = db_mmyy_set | az_mmyy_set
-        combined_mmyy_list = [list(mmyy) for mmyy in combined_mmyy_set]
+        unpushed_ids = set(changes_df.loc[changes_df.action == intents['SHAREPOINT_ADD_RECORD'], 'record_id'])
+        change_ids = changes_df.groupby('record_id')['change_id'].apply(list).to_dict()
+        records_df = changes_df.drop_duplicates('record_id', keep='last')
 
-        # self.logger.info(f"Combined list: {combined_mmyy_list}")
+        skip_mask = (records_df.date < self.latest_date) | (records_df.is_cancelled & records_df.record_id.isin(unpushed_ids))
+        self.mark_changes_processed([id for record_id in records_df.loc[skip_mask, 'record_id'] for id in change_ids[record_id]])
+        records_df = records_df.loc[~skip_mask].copy()
 
-        all_missing_job_names = {}
+        records_df['month'] = [date.month for date in records_df.date]
+        records_df['year'] = [date.year for date in records_df.date]
+        months = [(mm, yy, month_df) for (mm, yy), month_df in records_df.groupby(['month', 'year'])]
 
-        for mm, yy in combined_mmyy_list: # contains the mm, yy that are >= ysterday
+        for dates_to_del, del_status, dates_to_update, add_status in self.sync_months(self.push_changes_month, months):
+            processed_ids = []
 
-            # self.logger.info(f"month: {mm}, year: {yy}")
+            for dates, action, status in [(dates_to_del, intents['SHAREPOINT_DEL_RECORD'], del_status), (dates_to_update, intents['SHAREPOINT_ADD_RECORD'], add_status)]:
+                if dates.empty:
+                    continue
+                if status == SERVER_ERROR:
+                    self.error = True
+                for name, group in dates.groupby('name'):
+                    self.set_sync_status(action, status, group['record_id'].tolist(), name)
+                if status == OK:
+                    processed_ids.extend(dates.record_id)
 
-            self.cur_manager = SpreadsheetManager(mmyy=[mm, yy])
+            self.mark_changes_processed([id for record_id in processed_ids for id in change_ids[record_id]])
+            session.commit()
 
-            # get azure df
-            self.get_az_df()
+        session.commit()
 
-            # get db df, including cancelled records
-            self.get_db_df(mm, yy)
+    def diff_month(self, mm, yy, db_df):
+        '''reads the month's table, diffs it against db_df and pushes the difference. Returns None when there is nothing to sync'''
+        import pandas as pd
+        from azure.sheet_manager import SpreadsheetManager
 
-            # dates_to_del: in az, not in db. dates_to_update: in db, not in az
-            combined_df = pd.merge(self.cur_az_df, self.cur_db_df, how="outer", indicator=True)
-            combined_df['_merge'] = combined_df['_merge'].replace({'left_only': 'az_only', 'right_only': 'db_only'})
+        manager = SpreadsheetManager(mmyy=[mm, yy])
 
-            self.logger.info("Printing combined df")
-            self.logger.info(combined_df)
-            self.logger.info(combined_df.dtypes)
+        # get azure df
+        az_df = self.get_az_df(manager)
 
-            if combined_df.empty:
-                self.commit_status(OK, _forwards=True)
-                self.reply = "Nothing to sync"
-                return
+        # dates_to_del: in az, not in db. dates_to_update: in db, not in az
+        combined_df = pd.merge(az_df, db_df, how="outer", indicator=True)
+        combined_df['_merge'] = combined_df['_merge'].replace({'left_only': 'az_only', 'right_only': 'db_only'})
 
-            # both but cancelled or az only (no record ever made in local db) means have to del from Sharepoint
-            combined_df.loc[(((combined_df._merge == "both") & (combined_df.is_cancelled == True)) | (combined_df._merge == "az_only")), "action"] = intents['SHAREPOINT_DEL_RECORD']
-            # PASS: both and not cancelled means updated on both sides
-            # db only and not cancelled means need to add to Sharepoint
-            combined_df.loc[((combined_df._merge == "db_only") & (combined_df.is_cancelled == False)), "action"] = intents['SHAREPOINT_ADD_RECORD']
-            # PASS: right only and cancelled means updated on both sides
+        self.logger.info("Printing combined df")
+        self.logger.info(combined_df)
+        self.logger.info(combined_df.dtypes)
 
-            dates_to_del = combined_df.loc[combined_df.action == intents['SHAREPOINT_DEL_RECORD']].copy()
-            dates_to_update = combined_df.loc[combined_df.action == intents['SHAREPOINT_ADD_RECORD']].copy()
+        if combined_df.empty:
+            return None
 
-            # self.logger.info("Printing dates to del and add")
-            # self.logger.info(dates_to_del)
-            # self.logger.info(dates_to_update)
-            self.logger.info(f"length of data to del: {dates_to_del.shape}")
-            self.logger.info(f"length of data to add: {dates_to_update.shape}")
+        # both but cancelled or az only (no record ever made in local db) means have to del from Sharepoint
+        combined_df.loc[(((combined_df._merge == "both") & (combined_df.is_cancelled == True)) | (combined_df._merge == "az_only")), "action"] = intents['SHAREPOINT_DEL_RECORD']
+        # PASS: both and not cancelled means updated on both sides
+        # db only and not cancelled means need to add to Sharepoint
+        combined_df.loc[((combined_df._merge == "db_only") & (combined_df.is_cancelled == False)), "action"] = intents['SHAREPOINT_ADD_RECORD']
+        # PASS: right only and cancelled means updated on both sides
 
-            if dates_to_del.empty and dates_to_update.empty:
-                self.commit_status(OK, _forwards=True)
-                self.reply = "Nothing to sync"
-                return
-            
-            if not dates_to_del.empty:
-                # delete from excel
-                indexes_to_rm = dates_to_del["az_index"].dropna().astype(int).tolist()
-                self.logger.info(f"indexes to remove: {indexes_to_rm}")
+        dates_to_del = combined_df.loc[combined_df.action == intents['SHAREPOINT_DEL_RECORD']].copy()
+        dates_to_update = combined_df.loc[combined_df.action == intents['SHAREPOINT_ADD_RECORD']].copy()
 
-                # cancel MCs
-                try:
-                    self.cur_manager.delete_from_excel(indexes_to_rm)
-                    del_status = OK
-                except AzureSyncError as e:
+        # self.logger.info("Printing dates to del and add")
+        # self.logger.info(dates_to_del)
+        # self.logger.info(dates_to_update)
+        self.logger.info(f"length of data to del: {dates_to_del.shape}")
+        self.logger.info(f"length of data to add: {dates_to_update.shape}")
+
+        if dates_to_del.empty and dates_to_update.empty:
+            return None
+
+        del_status = add_status = None
+
+        if not dates_to_del.empty:
+            # delete from excel
+            indexes_to_rm = dates_to_del["az_index"].dropna().astype(int).tolist()
+            self.logger.info(f"indexes to remove: {indexes_to_rm}")
+
+            # cancel MCs
+            try:
+                manager.delete_from_excel(indexes_to_rm)
+                del_status = OK
+            except AzureSyncError as e:
+                del_status = SERVER_ERROR
+                self.logger.error(e.message)
+
+        # Add MCs
+        # add to excel
+
+        if not dates_to_update.empty:
+            data_to_add = list(dates_to_update.apply(self.format_row, axis=1))
+            try:
+                manager.upload_data(data_to_add)
+                add_status = OK
+            except AzureSyncError as e:
+                add_status = SERVER_ERROR
+                self.logger.error(e.message)
+
+        return dates_to_del, del_status, dates_to_update, add_status
+
+    def full_sync(self):
+        '''diffs every monthly table from yesterday onwards against the database, with the months read and pushed concurrently. Changes logged before it started are covered if it succeeds'''
+        import pandas as pd
+        from models.leave_records import LeaveRecordChange
+
+        session = get_session()
+
+        last_change_id = session.query(func.max(LeaveRecordChange.id)).filter(LeaveRecordChange.processed_at == None).scalar()
+
+        self.az_mmyy_arr = loop_leave_files(latest_date=self.latest_date)
+        # self.logger.info(self.az_mmyy_arr)
+        self.db_mmyy_arr = self.get_all_mmyy_in_db()
+        # self.logger.info(self.db_mmyy_arr)
+
+        db_mmyy_set = set(tuple(mmyy) for mmyy in self.db_mmyy_arr)
+        az_mmyy_set = set(tuple(mmyy) for mmyy in self.az_mmyy_arr)
+        combined_mmyy_set = db_mmyy_set | az_mmyy_set
+        combined_mmyy_list = sorted(combined_mmyy_set, key=lambda mmyy: (mmyy[1], mmyy[0]))
+
+        # self.logger.info(f"Combined list: {combined_mmyy_list}")
+
+        # get db df, including cancelled records, for every month before the threads start
+        months = [(mm, yy, self.get_db_df(mm, yy)) for mm, yy in combined_mmyy_list] # contains the mm, yy that are >= ysterday
+
+        for result in self.sync_months(self.diff_month, months):
+            if result is None:
+                continue
+
+            dates_to_del, del_status, dates_to_update, add_status = result
+
+            if not dates_to_del.empty:
+                if del_status == SERVER_ERROR:
                     self.error = True
-                    del_status = SERVER_ERROR
-                    self.logger.error(e.message)
-                
+
                 del_grouped = dates_to_del.groupby(['_merge', 'name'], observed=True)
                 for (_merge, name), group in del_grouped:
                     del_dates = [date for date in group['date'] if not pd.isna(date)]
                     if _merge == "az_only": # blank row / no match with db. if no match and name: send a spearate message
                         if name and not pd.isna(name) and len(del_dates) > 0:
                             self.logger.info(f"Name added: {name}")
-                            if name not in all_missing_job_names:
-                                all_missing_job_names[name] = []
-                            all_missing_job_names[name].extend(del_dates)
+                            if name not in self.all_missing_job_names:
+                                self.all_missing_job_names[name] = []
+                            self.all_missing_job_names[name].extend(del_dates)
                         continue
-                    
-                    for id in group['record_id'].tolist():
-                        record = session.query(LeaveRecord).filter_by(id=id).first()
-                        if record and record.sync_status != del_status: 
-                            record.sync_status = del_status
-                            self.update_records(intents['SHAREPOINT_DEL_RECORD'], del_status, name, record.date)
-
-            # Add MCs
-            # add to excel
-            
+
+                    self.set_sync_status(intents['SHAREPOINT_DEL_RECORD'], del_status, group['record_id'].tolist(), name)
+
             if not dates_to_update.empty:
-                data_to_add = list(dates_to_update.apply(self.format_row, axis=1))
-                try:
-                    self.cur_manager.upload_data(data_to_add)
-                    add_status = OK
-                except AzureSyncError as e:
+                if add_status == SERVER_ERROR:
                     self.error = True
-                    add_status = SERVER_ERROR
-                    self.logger.error(e.message)
 
                 add_grouped = dates_to_update.groupby(['_merge', 'name'], observed=True)
                 for (_merge, name), group in add_grouped:
-                    for id in group['record_id'].tolist():
-                        record = session.query(LeaveRecord).filter_by(id=id).first()
-                        if record and record.sync_status != add_status: 
-                            record.sync_status = add_status
-                            self.logger.info(f"add record number: {intents['SHAREPOINT_ADD_RECORD']}")
-                            self.update_records(intents['SHAREPOINT_ADD_RECORD'], add_status, name, record.date)
+                    self.set_sync_status(intents['SHAREPOINT_ADD_RECORD'], add_status, group['record_id'].tolist(), name)
             session.commit()
 
-        if len(self.records) > 0:
-            self.logger.info("sending messages")
-            self.logger.info(f"records of new leaves: {self.records}")
-            self.get_sharepoint_leave_sync_notify_cv()
-            self.logger.info(f"content variables: {self.cv_and_users_list}")
-            MessageForward.forward_template_msges(self)
-
-        if self.error == True:
-            self.reply = "Error connecting to Azure"
-        else:
-            self.reply = "Sync was successful"
-
-            if len(all_missing_job_names) > 0:
-                names_dates_str = '; '.join(f"{name}: {print_all_dates(date_list, date_obj=True)}" for name, date_list in all_missing_job_names.items())
-                self.reply += f". Also, unmatched records were found in Azure: {names_dates_str}"
-
-    
-
-
-
-
-
-
-            
-            
-
-            
-
+        if last_change_id and not self.error:
+            session.query(LeaveRecordChange).filter(
+                LeaveRecordChange.processed_at == None,
+                LeaveRecordChange.id <= last_change_id
+            ).update({"processed_at": current_sg_time()}, synchronize_session=False)
+            session.commit()
@@ -1,15 +1,17 @@
 from models.jobs.system.abstract import JobSystem
 import os
+from sqlalchemy.dialects.postgresql import insert
 
-import requests
-import pandas as pd
-import numpy as np
+from azure.graph import graph
 import traceback
 
-from azure.utils import generate_header
+from azure.utils import generate_header, delay_decorator
 from extensions import db, get_session
 from models.users import User
 from models.exceptions import AzureSyncError
+from models.metrics import Metric
+from constants import system
+from counters import counters
 
 from logs.config import setup_logger
 from utilities import join_with_commas_and
@@ -32,6 +34,27 @@ class JobSyncUsers(JobSystem):
         self.header = generate_header()
         self.failed_users = []
         self.affected_users = []
+        self.users_file_tag = None
+
+    def get_users_file_tag(self):
+        '''Returns the cTag of the users workbook, which only changes with its content, from a metadata request that does not open the workbook'''
+
+        USERS_FILE_URL = f"https://graph.microsoft.com/v1.0/drives/{os.environ.get('DRIVE_ID')}/items/{os.environ.get('USERS_FILE_ID')}"
+
+        # retried like the other Graph reads, eg. when throttled
+        @delay_decorator("Failed to read users file metadata")
+        def _get_users_file():
+            return graph.get(url=USERS_FILE_URL, headers=self.header, params={"$select": "id,cTag,lastModifiedDateTime"})
+
+        response = _get_users_file()
+
+        if not 200 <= response.status_code < 300:
+            raise AzureSyncError(f"Failed to read users file metadata. {response.text}")
+
+        try:
+            return response.json()['cTag']
+        except (KeyError, ValueError):
+            raise AzureSyncError("Connection to Azure failed")
 
     def sync_user_info(self):
 
@@ -43,7 +66,7 @@ class JobSyncUsers(JobSystem):
 
         # Make a GET request to the provided url, passing the access token in a header
 
-        response = requests.get(url=USERS_TABLE_URL, headers=self.header)
+        response = graph.get(url=USERS_TABLE_URL, headers=self.header)
 
         try:
             data = [tuple(info) for object_info in response.json()['value'] for info in object_info['values']]
@@ -59,15 +82,100 @@ class JobSyncUsers(JobSystem):
     @staticmethod
     def df_replace_spaces(df):
         '''Replaces empty strings with NaN, removes entirely blank rows, and sets empty aliases to names.'''
+        import numpy as np
+
         df = df.replace({np.nan: None, '': None })
         df = df.dropna(how="all")
         df['alias'] = df.apply(lambda x: x['name'] if x['alias'] == None else x['alias'], axis=1)
         return df
 
+    def record_failed_user(self, name, az_users):
+        self.failed_users.append(name)
+        self.affected_users.extend(list(az_users.loc[az_users.reporting_officer_name == name, "name"]))
+        self.error = True
+
+    def delete_users(self, names):
+        '''Deletes the users in one statement, falling back to a savepoint per user to find the ones that cannot be deleted'''
+        session = get_session()
+
+        if len(names) == 0:
+            return
+
+        try:
+            with session.begin_nested():
+                session.query(User).filter(User.name.in_(names)).delete(synchronize_session=False)
+            return
+        except Exception:
+            self.logger.error(traceback.format_exc())
+
+        for name in names:
+            try:
+                with session.begin_nested():
+                    session.query(User).filter_by(name=name).delete(synchronize_session=False)
+            except Exception:
+                self.logger.error(traceback.format_exc())
+                self.error = True
+
+    def upsert_users(self, rows, az_users):
+        '''
+        Inserts or updates the users, including their reporting officers, with one INSERT ... ON CONFLICT DO UPDATE. Reporting officers added in the same statement pass the foreign key since it is checked at the end of the statement.
+
+        If the statement fails, the rows are retried in a savepoint each, without reporting officers first and then setting them, so failed_users and affected_users name the rows at fault
+        '''
+        session = get_session()
+
+        if len(rows) == 0:
+            return
+
+        stmt = insert(User).values(rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.name],
+            set_={col: stmt.excluded[col] for col in rows[0] if col != 'name'}
+        )
+
+        try:
+            with session.begin_nested():
+                session.execute(stmt)
+            return
+        except Exception:
+            self.logger.error(traceback.format_exc())
+
+        upserted = []
+        for row in rows:
+            user_row = dict(row, reporting_officer_name=None)
+            stmt = insert(User).values(user_row)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[User.name],
+                set_={col: stmt.excluded[col] for col in user_row if col not in ['name', 'reporting_officer_name']}
+            )
+            try:
+                with session.begin_nested():
+                    session.execute(stmt)
+                upserted.append(row)
+            except Exception:
+                self.logger.error(traceback.format_exc())
+                self.record_failed_user(row['name'], az_users)
+
+        for row in upserted:
+            try:
+                with session.begin_nested():
+                    session.query(User).filter_by(name=row['name']).update({"reporting_officer_name": row['reporting_officer_name']}, synchronize_session=False)
+            except Exception:
+                self.logger.error(traceback.format_exc())
+                self.error = True
+
     def update_user_database(self):
+        import pandas as pd
 
         session = get_session()
 
+        metric = Metric.get_metric(system['SYNC_USERS'])
+        self.users_file_tag = self.get_users_file_tag()
+        if metric.last_seen_tag and metric.last_seen_tag == self.users_file_tag:
+            self.logger.info(f"users file unchanged since tag {self.users_file_tag}")
+            counters.incr("sync_users.unchanged")
+            return
+
         col_order = ['name', 'alias', 'number', 'dept', 'reporting_officer_name', 'is_global_admin', 'is_dept_admin']
 
         # SECTION AZURE SIDE
@@ -152,66 +260,20 @@ class JobSyncUsers(JobSystem):
             
             # NEED APP CONTEXT
 
-            for name in old_users:
-                try:
-                    session.query(User).filter_by(name=name).delete()
-                except Exception as e:
-                    self.logger.error(traceback.format_exc())
-                    session.rollback()
-                    self.error = True
-            session.commit()
-
+            self.delete_users(old_users)
             self.logger.info("removed old")
 
-            for name, alias, number, dept, _, is_global_admin, is_dept_admin in updated_users_tuples:
-                try:
-                    existing_user = session.query(User).filter(User.name == name).first()
-                    
-                    if existing_user:
-                        existing_user.alias = alias
-                        existing_user.number = number
-                        existing_user.dept = dept
-                        existing_user.is_global_admin = is_global_admin
-                        existing_user.is_dept_admin = is_dept_admin
-                    else:
-                        self.logger.info(f"User {name} not found for update.")
-                    session.commit()
-                except Exception as e:
-                    self.logger.error(traceback.format_exc())
-                    session.rollback()
-                    new_affected_users = list(az_users.loc[az_users.reporting_officer_name == name, "name"])
-                    self.failed_users.extend([name])
-                    self.affected_users.extend(new_affected_users)
-                    self.error = True
-
-            for name, alias, number, dept, _, is_global_admin, is_dept_admin in new_users_tuples:
-                # self.logger.info(f"alias: {alias}")
-                new_user = User(name=name, alias=alias, number=number, dept=dept, is_global_admin=is_global_admin, is_dept_admin=is_dept_admin)
-                try:
-                    session.add(new_user)
-                    session.commit()
-                except Exception as e:
-                    self.logger.error(traceback.format_exc())
-                    session.rollback()
-                    new_affected_users = list(az_users.loc[(az_users.reporting_officer_name == name), "name"])
-                    self.failed_users.extend(name)
-                    self.affected_users.extend(new_affected_users)
-                    self.error = True
-            
             new_users_tuples.extend(updated_users_tuples)
-
-            for name, _, _, _, reporting_officer, _, _ in new_users_tuples:
-                user = session.query(User).filter_by(name=name).first()
-                try:
-                    user.reporting_officer_name = reporting_officer
-                    session.commit()
-                except Exception as e:
-                    self.logger.error(traceback.format_exc())
-                    session.rollback()
-                    self.error = True
+            self.upsert_users([dict(zip(col_order, user)) for user in new_users_tuples], az_users)
+            session.commit()
 
             self.logger.info("added new")
 
+        if not self.error:
+            # only once the table is in the database, so a failed sync is retried on the next run
+            metric.last_seen_tag = self.users_file_tag
+            session.commit()
+
     def main(self):
         self.logger.info("IN SYNC USERS")
         try:
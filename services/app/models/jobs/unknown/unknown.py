@@ -16,7 +16,7 @@ class JobUnknown(Job):
 
     job_no = db.Column(db.ForeignKey("job.job_no"), primary_key=True)
 
-    from_no = db.Column(db.String(30), nullable=False)
+    from_no = db.Column(db.String(30), nullable=False, index=True)
     
     __mapper_args__ = {
         "polymorphic_identity": "job_unknown",
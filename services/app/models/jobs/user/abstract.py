@@ -34,7 +34,7 @@ class JobUser(Job): # Abstract class
 
     job_no = db.Column(db.ForeignKey("job.job_no"), primary_key=True)
     
-    name = db.Column(db.String(80), nullable=True) # dont create relationship otherwise the name is gone after deleted
+    name = db.Column(db.String(80), nullable=True, index=True) # dont create relationship otherwise the name is gone after deleted
     is_cancelled = db.Column(db.Boolean, default=False, nullable=False)
     
     __mapper_args__ = {
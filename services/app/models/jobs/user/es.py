@@ -9,7 +9,6 @@ import os
 
 from overrides import overrides
 
-from es.manage import search_for_document
 from models.exceptions import ReplyError, DurationError
 from models.jobs.user.abstract import JobUser
 
@@ -79,6 +78,7 @@ class JobEs(JobUser):
             self.logger.info("job complete")
 
     def get_es_reply(self):
+        from es.manage import search_for_document
 
         session = get_session()
         result = search_for_document(self.received_msg.body)
@@ -16,7 +16,6 @@ from models.exceptions import ReplyError, DurationError
 from models.jobs.user.abstract import JobUser
 from models.leave_records import LeaveRecord
 
-from constants import leave_keywords, leave_types
 import re
 import traceback
 from .utils_leave import dates
@@ -130,15 +129,10 @@ class JobLeave(JobUser):
         pass
     
     def set_leave_type(self):
-        leave_keyword_patterns = re.compile(leave_keywords, re.IGNORECASE)
-        leave_match = leave_keyword_patterns.search(self.user_str)
-
-        if leave_match:
-            matched_term = leave_match.group(0) if leave_match else None
-            for leave_type, phrases in leave_types.items():
-                if matched_term.lower() in [phrase.lower() for phrase in phrases]:
-                    return leave_type
-            # UNKNOWN ERROR... keyword found but couldnt lookup
+        parsed_leave = getattr(self, "parsed_leave", None) or dates.leave_parser.parse(self.user_str)
+
+        if parsed_leave.leave_type:
+            return parsed_leave.leave_type
         
         content_sid = os.environ.get('SELECT_LEAVE_TYPE_SID')
         cv = None
@@ -178,11 +172,13 @@ class JobLeave(JobUser):
 
         self.logger.info(f"User string in generate base: {self.user_str}")
 
+        self.parsed_leave = dates.leave_parser.parse(self.user_str)
+        self.logger.info(f"parsed leave: {self.parsed_leave}")
+
         try:
 
             # self.duration is extracted duration
-            if dates.duration_extraction(self.user_str):
-                self.duration = int(dates.duration_extraction(self.user_str))
+            self.duration = self.parsed_leave.duration
 
             duration_c = self.set_start_end_date() # checks for conflicts and sets the dates
 
@@ -253,25 +249,16 @@ class JobLeave(JobUser):
 
         
     def set_start_end_date(self):
-        '''This function uses self.user_str and returns True or False, at the same time setting start and end dates where possible and resolving possible conflicts. Checks if can do something about start date, end date and duration'''
+        '''This function uses self.parsed_leave and returns the duration or None, at the same time setting start and end dates where possible and resolving possible conflicts. Checks if can do something about start date, end date and duration'''
 
-        named_month_start, named_month_end = dates.named_month_extraction(self.user_str)
-        ddmm_start, ddmm_end = dates.named_ddmm_extraction(self.user_str)
-        day_start, day_end = dates.named_day_extraction(self.user_str)
-        
-        start_dates = [date for date in [named_month_start, ddmm_start, day_start] if date is not None]
-        end_dates = [date for date in [named_month_end, ddmm_end, day_end] if date is not None]
+        start_dates = self.parsed_leave.start_dates
+        end_dates = self.parsed_leave.end_dates
 
         self.logger.info(f"{start_dates}, {end_dates}")
 
-        if len(start_dates) > 1:
+        for name, conflicting_dates in self.parsed_leave.conflicts.items():
 
-            body = f'Conflicting start dates {join_with_commas_and(datetime.strptime(date, "%d/%m/%Y") for date in start_dates)}. Please send another message with the form "from dd/mm to dd/mm" to indicate the MC dates. Thank you!'
-
-            raise DurationError(body)
-        if len(end_dates) > 1:
-            
-            body = f'Conflicting end dates {join_with_commas_and(datetime.strptime(date, "%d/%m/%Y") for date in end_dates)}. Please send another message with the form "from dd/mm to dd/mm" to indicate the MC dates. Thank you!'
+            body = f'Conflicting {name} dates {join_with_commas_and([date.strftime("%d/%m/%Y") for date in conflicting_dates])}. Please send another message with the form "from dd/mm to dd/mm" to indicate the MC dates. Thank you!'
 
             raise DurationError(body)
         
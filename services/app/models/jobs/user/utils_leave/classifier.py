@@ -0,0 +1,34 @@
+from functools import lru_cache
+import re
+
+from constants import intents, leave_keywords, leave_alt_words, leave_types
+
+class LeaveClassifier:
+    '''
+    Classifies an inbound message into (intent, leave type), built once from constants.
+
+    Every leave keyword also matches leave_alt_words, so a keyword match decides both the intent and the leave type, and leave_alt_words is only searched when there is none
+    '''
+
+    leave_keyword_pattern = re.compile(leave_keywords, re.IGNORECASE)
+    leave_alt_words_pattern = re.compile(leave_alt_words, re.IGNORECASE)
+    phrase_to_leave_type = {phrase.lower(): leave_type for leave_type, phrases in leave_types.items() for phrase in phrases}
+
+    @lru_cache(maxsize=256) # check_for_intent and JobLeave.set_leave_type classify the same message
+    def classify(self, message):
+        leave_match = self.leave_keyword_pattern.search(message)
+        if leave_match:
+            return intents['TAKE_LEAVE'], self.phrase_to_leave_type[leave_match.group(0).lower()]
+
+        if self.leave_alt_words_pattern.search(message):
+            return intents['TAKE_LEAVE'], None
+
+        return intents['ES_SEARCH'], None
+
+    def intent(self, message):
+        return self.classify(message)[0]
+
+    def leave_type(self, message):
+        return self.classify(message)[1]
+
+leave_classifier = LeaveClassifier()
@@ -5,6 +5,7 @@ from dateutil.relativedelta import relativedelta
 import logging
 import traceback
 from utilities import current_sg_time
+from .classifier import leave_classifier
 
 from logs.config import setup_logger
 
@@ -17,7 +18,7 @@ def generate_date_obj(match_obj, date_format):
     '''returns date object from the regex groups, where there are typically 2 groups: start date and end date'''
     logging.info("matching dates")
     date = None
-    logging.info(match_obj.group("date"), match_obj.group("month"))
+    logging.info(f'{match_obj.group("date")} {match_obj.group("month")}')
     if match_obj.group("date") and match_obj.group("month"):
         date = f'{match_obj.group("date")} {match_obj.group("month")} {current_sg_time().year}'
         date = datetime.strptime(date, date_format).date() # create datetime object
@@ -49,28 +50,29 @@ def replace_with_full_month(match):
     # Return the capitalized full month name from the dictionary
     return month_mapping[month_key]
 
-def named_month_extraction(message):
-    '''Check for month pattern ie. 11 November or November 11'''
-    user_str = re.sub(months_regex, replace_with_full_month, message, flags=re.IGNORECASE)
+# the month extraction only accepts from/on and to/until/til(l) as prefixes, unlike the other extractors
+named_month_patterns = [
+    (
+        re.compile(r'(from|on)\s(' + date_first_pattern + r')', re.IGNORECASE),
+        re.compile(r'(to|until|til(l)?)\s(' + date_first_pattern + r')', re.IGNORECASE)
+    ),
+    (
+        re.compile(r'(from|on)\s(' + month_first_pattern + r')', re.IGNORECASE),
+        re.compile(r'(to|until|til(l)?)\s(' + month_first_pattern + r')', re.IGNORECASE)
+    ),
+]
 
-    #SECTION proper dates
-    months = r'January|February|March|April|May|June|July|August|September|October|November|December'
-    date_pattern = r'(?P<date>\d{1,2})(st|nd|rd|th)?'
-    month_pattern = r'(?P<month>' + months + r')'
+compiled_months_regex = re.compile(months_regex, re.IGNORECASE)
 
-    date_first_pattern = date_pattern + r'\s*' + month_pattern
-    month_first_pattern = month_pattern + r'\s*' + date_pattern
+def named_month_extraction(message):
+    '''Check for month pattern ie. 11 November or November 11'''
+    user_str = compiled_months_regex.sub(replace_with_full_month, message)
+    return month_dates(user_str)
 
-    start_date_pattern = r'(from|on)\s(' + date_first_pattern + r')'
-    end_date_pattern = r'(to|until|til(l)?)\s(' + date_first_pattern + r')'
+def month_dates(user_str):
+    '''searches a string with the months already replaced by their full names, trying the date first pattern before the month first pattern'''
 
-    start_date_pattern_2 = r'(from|on)\s(' + month_first_pattern + r')'
-    end_date_pattern_2 = r'(to|until|til(l)?)\s(' + month_first_pattern + r')'
-    
-
-    def get_dates(start_date_pattern, end_date_pattern):
-        compiled_start_date_pattern = re.compile(start_date_pattern, re.IGNORECASE)
-        compiled_end_date_pattern = re.compile(end_date_pattern, re.IGNORECASE)
+    for compiled_start_date_pattern, compiled_end_date_pattern in named_month_patterns:
         start_match_dates = compiled_start_date_pattern.search(user_str)
         end_match_dates = compiled_end_date_pattern.search(user_str)
         start_date = end_date = None
@@ -80,15 +82,10 @@ def named_month_extraction(message):
             end_date = generate_date_obj(end_match_dates, "%d %B %Y")
             if start_date == None:
                 start_date = current_sg_time().date()
-        return (start_date, end_date)
+        if start_date or end_date:
+            break
 
-    dates = get_dates(start_date_pattern, end_date_pattern) # try first pattern
-    
-    if len([date for date in dates if date is not None]) > 0:
-        return dates
-    else:
-        dates = get_dates(start_date_pattern_2, end_date_pattern_2) # try 2nd pattern
-        return dates
+    return (start_date, end_date)
     
 
 # SECTION 2. 5/12 
@@ -101,14 +98,14 @@ ddmm_pattern = r'(?P<date>' + dd_pattern + r')/(?P<month>' + mm_pattern + r')'
 ddmm_start_date_pattern = r'(' + start_prefixes + r')\s(' + ddmm_pattern + r')' 
 ddmm_end_date_pattern = r'(' + end_prefixes + r')\s(' + ddmm_pattern + r')'
 
+compiled_ddmm_start_date_pattern = re.compile(ddmm_start_date_pattern, re.IGNORECASE)
+compiled_ddmm_end_date_pattern = re.compile(ddmm_end_date_pattern, re.IGNORECASE)
+
 def named_ddmm_extraction(leave_message):
     '''Check for normal date pattern ie. 11/11 or something'''
 
-    compiled_start_date_pattern = re.compile(ddmm_start_date_pattern, re.IGNORECASE)
-    compiled_end_date_pattern = re.compile(ddmm_end_date_pattern, re.IGNORECASE)
-
-    match_start_dates = compiled_start_date_pattern.search(leave_message)
-    match_end_dates = compiled_end_date_pattern.search(leave_message)
+    match_start_dates = compiled_ddmm_start_date_pattern.search(leave_message)
+    match_end_dates = compiled_ddmm_end_date_pattern.search(leave_message)
 
     start_date = end_date = None
 
@@ -134,15 +131,14 @@ leave_type_max_two_words = r'(\b\w+\b\s+){0,2}'
 alternative1 = duration_pattern + r'\s.*?' + day_pattern + r'\s.*?' + leave_type_max_two_words + leave_alt_words
 alternative2 = leave_type_max_two_words + leave_alt_words + r'\s.*?' + alternative_duration_pattern + r'\s.*?' + day_pattern
 
-# Combine the two main alternatives into the final pattern
-final_duration_extraction = r'\b.*?(?:on|taking|take) (' + alternative1 + r'|' + alternative2 + r')\b'
+# Combine the two main alternatives into the final pattern. search already tries every position, a leading .*? only made it quadratic
+final_duration_extraction = r'(?:on|taking|take) (' + alternative1 + r'|' + alternative2 + r')\b'
+
+urgent_absent_pattern = re.compile(final_duration_extraction, re.IGNORECASE)
 
 def duration_extraction(message):
     '''ran always to check if user gave any duration'''
 
-    # Combine the two main alternatives into the final pattern
-    urgent_absent_pattern = re.compile(final_duration_extraction, re.IGNORECASE)
-
     match_duration = urgent_absent_pattern.search(message)
     if match_duration:
         duration = match_duration.group("duration1") or match_duration.group("duration2")
@@ -196,19 +192,19 @@ def replace_with_full_day(match):
     # Return the capitalized full month name from the dictionary
     return prefix + ' ' + day_mapping[day_key]
 
+compiled_days_regex = re.compile(days_regex, re.IGNORECASE)
+compiled_start_day_pattern = re.compile(start_day_pattern, re.IGNORECASE)
+compiled_end_day_pattern = re.compile(end_day_pattern, re.IGNORECASE)
+
 def named_day_extraction(message):
     '''checks the body for days, returns (start_date, end_date)'''
 
-    logging.info(start_day_pattern)
-    logging.info(f"negative lookbehinds: {negative_lookbehinds}")
-
-    # days_regex, start_day_pattern, and end_day_pattern can be found in constants.py
-    user_str = re.sub(days_regex, replace_with_full_day, message, flags=re.IGNORECASE)
-
+    user_str = compiled_days_regex.sub(replace_with_full_day, message)
     logging.info(f"new user string: {user_str}")
+    return day_dates(user_str)
 
-    compiled_start_day_pattern = re.compile(start_day_pattern, re.IGNORECASE)
-    compiled_end_day_pattern = re.compile(end_day_pattern, re.IGNORECASE)
+def day_dates(user_str):
+    '''searches a string with the days already replaced by their full names'''
 
     start_days = compiled_start_day_pattern.search(user_str)
     end_days = compiled_end_day_pattern.search(user_str)
@@ -257,7 +253,7 @@ def get_future_date(start_day, end_day, start_week_offset, end_week_offset):
             # if end_week_offset > 0:
             #     end_week_offset -= 1 #TODO TEST
         else:
-            logging.info(start_week_offset, end_week_offset)
+            logging.info(f"{start_week_offset} {end_week_offset}")
             diff = start_day - today_weekday
         start_date = today + timedelta(days=diff + 7 * start_week_offset)
         
@@ -279,7 +275,71 @@ def get_future_date(start_day, end_day, start_week_offset, end_week_offset):
     else:
         end_date = None
 
-    logging.info(start_date, end_date)
+    logging.info(f"{start_date} {end_date}")
 
     return (start_date, end_date)
 
+
+
+# SECTION 5. parser
+class ParsedLeave:
+    '''Result of LeaveMessageParser.parse. start_dates and end_dates hold every date found by the extractors, more than 1 is a conflict'''
+
+    def __init__(self, start_dates, end_dates, duration, leave_type):
+        self.start_dates = start_dates
+        self.end_dates = end_dates
+        self.duration = duration
+        self.leave_type = leave_type
+
+    @property
+    def start_date(self):
+        return self.start_dates[0] if len(self.start_dates) == 1 else None
+
+    @property
+    def end_date(self):
+        return self.end_dates[0] if len(self.end_dates) == 1 else None
+
+    @property
+    def conflicts(self):
+        return {
+            name: dates for name, dates in (("start", self.start_dates), ("end", self.end_dates)) if len(dates) > 1
+        }
+
+    def __repr__(self):
+        return f"ParsedLeave(start_dates={self.start_dates}, end_dates={self.end_dates}, duration={self.duration}, leave_type={self.leave_type})"
+
+class LeaveMessageParser:
+    '''
+    Parses a leave message with the patterns above, compiled once at import.
+
+    The month names and day names are normalised together in a single substitution pass, which the month and day extractors then share. The duration and dd/mm patterns are searched once each, and the leave type comes from leave_classifier
+    '''
+
+    # days_regex is tried first at every position, it consumes its prefix so the month alternative never matches inside it
+    normalise_pattern = re.compile(r'(?P<day_phrase>' + days_regex + r')|(?P<month_word>' + months_regex + r')', re.IGNORECASE)
+
+    def normalise(self, message):
+        def replace(match):
+            if match.group('day_phrase'):
+                return replace_with_full_day(match)
+            return month_mapping[match.group(0).lower()]
+
+        return self.normalise_pattern.sub(replace, message)
+
+    def parse(self, message):
+        user_str = self.normalise(message)
+
+        month_start, month_end = month_dates(user_str)
+        ddmm_start, ddmm_end = named_ddmm_extraction(message)
+        day_start, day_end = day_dates(user_str)
+
+        start_dates = [date for date in [month_start, ddmm_start, day_start] if date is not None]
+        end_dates = [date for date in [month_end, ddmm_end, day_end] if date is not None]
+
+        duration = duration_extraction(message)
+        if duration is not None:
+            duration = 1 if duration.lower() == "a" else int(duration)
+
+        return ParsedLeave(start_dates, end_dates, duration, leave_classifier.leave_type(message))
+
+leave_parser = LeaveMessageParser()
@@ -7,6 +7,7 @@ import time
 import shortuuid
 from datetime import timedelta, datetime
 from utilities import get_latest_date_past_9am, get_session, current_sg_time
+from constants import intents
 
 class LeaveRecord(db.Model):
 
@@ -24,15 +25,18 @@ class LeaveRecord(db.Model):
     job = db.relationship('JobLeave', backref=db.backref('leave_records'), lazy='select')
     is_cancelled = db.Column(db.Boolean, nullable=False)
 
+    __table_args__ = (
+        db.Index('ix_leave_records_job_no_date', 'job_no', 'date'), # update_local_db
+        db.Index('ix_leave_records_date', 'date'), # get_db_df and get_all_mmyy_in_db also read cancelled records
+        db.Index('ix_leave_records_date_active', 'date', postgresql_where=db.text('NOT is_cancelled')), # get_duplicates, get_all_leaves_today
+    )
+
     def __init__(self, job, date):
         self.id = shortuuid.ShortUUID().random(length=8)
         # self.name = user.name
         self.job_no = job.job_no
         self.date = date
         self.is_cancelled = False
-        session = get_session()
-        session.add(self)
-        session.commit()
 
     # @property
     # def user(self):
@@ -80,6 +84,7 @@ class LeaveRecord(db.Model):
         for date in job.dates_to_update:
             new_record = cls(job=job, date=date)
             session.add(new_record)
+            session.add(LeaveRecordChange(new_record, intents['SHAREPOINT_ADD_RECORD']))
         
         job.local_db_updated = True
         session.commit()
@@ -105,6 +110,7 @@ class LeaveRecord(db.Model):
                 record.is_cancelled = True
                 record.sync_status = None
                 record.cancelled_job_no = job.job_no
+                session.add(LeaveRecordChange(record, intents['SHAREPOINT_DEL_RECORD']))
                 job.dates_to_update.append(record.date)
             session.commit()
         
@@ -113,4 +119,23 @@ class LeaveRecord(db.Model):
 
         return f"Dates removed for {print_all_dates(job.dates_to_update, date_obj=True)}"
 
+class LeaveRecordChange(db.Model):
+    '''Outbox of leave record changes still to be pushed to Sharepoint, written in the same transaction as the record. JobSyncRecords sets processed_at once a change is reflected in the monthly file'''
+
+    __tablename__ = "leave_record_changes"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    record_id = db.Column(db.ForeignKey("leave_records.id", ondelete='CASCADE'), nullable=False)
+    action = db.Column(db.Integer, nullable=False) # intents SHAREPOINT_ADD_RECORD or SHAREPOINT_DEL_RECORD
+    created_at = db.Column(db.DateTime(timezone=True), nullable=False)
+    processed_at = db.Column(db.DateTime(timezone=True), default=None, nullable=True)
+
+    record = db.relationship('LeaveRecord', lazy='select')
+
+    __table_args__ = (
+        db.Index('ix_leave_record_changes_pending', 'id', postgresql_where=db.text('processed_at IS NULL')), # JobSyncRecords.get_pending_changes
+    )
 
+    def __init__(self, record, action):
+        self.record_id = record.id
+        self.action = action
+        self.created_at = current_sg_time()
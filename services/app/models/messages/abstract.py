@@ -1,4 +1,4 @@
-from extensions import db, get_session
+from extensions import db, get_session, hold_job_row
 # from sqlalchemy.orm import 
 from typing import List
 from constants import messages, PROCESSING
@@ -6,6 +6,7 @@ from dateutil.relativedelta import relativedelta
 from utilities import current_sg_time
 from config import twilio_client
 from sqlalchemy.orm import joinedload
+from sqlalchemy import func, update
 
 from logs.config import setup_logger
 
@@ -24,6 +25,10 @@ class Message(db.Model):
     job_no = db.Column(db.String, db.ForeignKey('job.job_no'), nullable=True)
     job = db.relationship('Job', backref='messages', lazy='select')
 
+    __table_args__ = (
+        db.Index('ix_message_job_no_seq_no', 'job_no', 'seq_no'), # get_seq_no and check_message_forwarded
+    )
+
     __mapper_args__ = {
         "polymorphic_on": "type",
         "polymorphic_identity": "message"
@@ -39,8 +44,7 @@ class Message(db.Model):
         if seq_no is not None:
             self.seq_no = seq_no
         else:
-            cur_seq_no = self.get_seq_no(job_no)
-            self.seq_no = cur_seq_no + 1
+            self.seq_no = self.next_seq_no(job_no)
         self.logger.info(f"new_message: {self.body}, seq no: {self.seq_no}")
         
     
@@ -51,6 +55,15 @@ class Message(db.Model):
     
     @staticmethod
     def create_message(msg_type, *args, **kwargs):
+        new_message = Message.build_message(msg_type, *args, **kwargs)
+        session = get_session()
+        session.commit()
+        Message.logger.info(f"created new message with seq number {new_message.seq_no}")
+        return new_message
+
+    @staticmethod
+    def build_message(msg_type, *args, **kwargs):
+        '''adds the new message to the session without committing, so that the caller can commit it together with its other changes'''
         if msg_type == messages['SENT']:
             from .sent import MessageSent
             new_message =  MessageSent(*args, **kwargs)
@@ -68,28 +81,38 @@ class Message(db.Model):
             raise ValueError(f"Unknown Message Type: {msg_type}")
         session = get_session()
         session.add(new_message)
-        session.commit()
-        Message.logger.info(f"created new message with seq number {new_message.seq_no}")
         return new_message
     
-    # TO CHECK
     @staticmethod
-    def get_seq_no(job_no):
-        '''finds the sequence number of the message in the job, considering all message types - therefore must use the parent class name instead of "cls"'''
+    def next_seq_no(job_no):
+        '''allocates the next sequence number of the job, considering all message types - therefore must use the parent class name instead of "cls".
+        
+        The increment of job.last_seq_no is a single UPDATE, so the row lock serialises concurrent callers until the message is committed. Every other writer of the job, eg. a status callback, waits on it too, so the caller must commit right after, with no Twilio or Graph requests in between: create_message, send_msg and forward_template_msges all do. MessageSent.send_msg checks this with check_no_job_row_held before it sends.
+
+        It is not moved to a transaction of its own, the caller's may have inserted the job or already hold its row lock, which a second transaction would not see or would wait on'''
+        from models.jobs.abstract import Job
 
         session = get_session()
-        for instance in session.identity_map.values():
-            logging.info(f"Instance in get_seq_no session: {instance}")
+        seq_no = session.execute(
+            update(Job).where(Job.job_no == job_no).values(last_seq_no=Job.last_seq_no + 1).returning(Job.last_seq_no)
+        ).scalar()
 
-        messages = session.query(Message).filter_by(job_no=job_no).all()
+        if seq_no is not None:
+            hold_job_row(session, job_no)
 
-        if len(messages) > 0:
-            # Then query the messages relationship
-            cur_seq_no = max(message.seq_no for message in messages)
-        else:
-            cur_seq_no = 0
+        if seq_no is None: # no job row, eg. job_no is None
+            seq_no = Message.get_seq_no(job_no) + 1
+
+        return seq_no
+
+    @staticmethod
+    def get_seq_no(job_no):
+        '''finds the current sequence number of the job from its messages'''
+
+        session = get_session()
+        cur_seq_no = session.query(func.max(Message.seq_no)).filter(Message.job_no == job_no).scalar()
 
-        return cur_seq_no
+        return cur_seq_no or 0
     
     @classmethod
     def get_message_by_sid(cls, sid):
@@ -12,7 +12,7 @@ from config import twilio_client
 from models.exceptions import ReplyError
 from .abstract import Message
 from .sent import MessageSent
-from constants import leave_alt_words
+from models.jobs.user.utils_leave.classifier import leave_classifier
 import logging
 
 from logs.config import setup_logger
@@ -38,12 +38,8 @@ class MessageReceived(Message):
         '''Function takes in a user input and if intent is not MC, it returns False. Else, it will return a list with the number of days, today's date and end date'''
         
         logging.info(f"message: {message}")
-                
-        leave_alt_words_pattern = re.compile(leave_alt_words, re.IGNORECASE)
-        if leave_alt_words_pattern.search(message):
-            return intents['TAKE_LEAVE']
-            
-        return intents['ES_SEARCH']
+
+        return leave_classifier.intent(message)
     
     @staticmethod
     def get_message(request):
@@ -59,14 +55,6 @@ class MessageReceived(Message):
         sid = request.form.get("MessageSid")
         return sid
 
-    def commit_reply_sid(self, sid):
-        session = get_session()
-        self.reply_sid = sid
-        session.commit()
-        self.logger.info(f"reply committed with sid {self.reply_sid}")
-
-        return True
-
 
     ########################
     # CHATBOT FUNCTIONALITY
@@ -80,9 +68,7 @@ class MessageReceived(Message):
 
         self.logger.info(f"message status: {self.status}, job status: {job.status}")
 
-        sent_msg = MessageSent.send_msg(messages['SENT'], self.reply, job)
-
-        self.commit_reply_sid(sent_msg.sid)
+        sent_msg = MessageSent.send_msg(messages['SENT'], self.reply, job, received_msg=self)
         # self.commit_status(OK)
 
         return sent_msg
@@ -95,7 +81,7 @@ class MessageConfirm(MessageReceived):
     sid = db.Column(db.ForeignKey("message_received.sid"), primary_key=True)
 
     #for comparison with the latest confirm message. sid is of the prev message, not the next reply
-    ref_msg_sid = db.Column(db.String(80), nullable=False)
+    ref_msg_sid = db.Column(db.String(80), nullable=False, index=True)
     _decision = db.Column(db.Integer, nullable=False)
 
     __mapper_args__ = {
@@ -1,5 +1,5 @@
-from extensions import db, get_session
-from constants import messages, intents, PENDING_CALLBACK, OK, MAX_UNBLOCK_WAIT
+from extensions import db, get_session, check_no_job_row_held
+from constants import messages, intents, PENDING_CALLBACK, OK, MAX_UNBLOCK_WAIT, FORWARD_MAX_WORKERS, TWILIO_MAX_MPS
 import os
 import json
 from config import twilio_client
@@ -7,14 +7,17 @@ from .abstract import Message
 import time
 import logging
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
 
-from utilities import join_with_commas_and, print_all_dates
+from utilities import join_with_commas_and, print_all_dates, RateLimiter
 
 from models.users import User
 from models.exceptions import ReplyError
 
 from logs.config import setup_logger
 
+twilio_rate_limiter = RateLimiter(TWILIO_MAX_MPS) # shared by all forward fan outs of the process
 
 # SECTION PROBLEM: If i ondelete=CASCADE, if a hod no longer references a user the user gets deleted
 # delete-orphan means that if a user's HOD or RO is no longer associated, it gets deleted
@@ -52,12 +55,10 @@ class MessageSent(Message):
         session.commit()
         self.logger.info(f"message committed with status {status}")
 
-        message = session.query(MessageSent).filter_by(sid=self.sid).first()
-        self.logger.info(f"message status: {message.status}, passed status: {status}")
         return True
 
     @classmethod
-    def send_msg(cls, msg_type, reply, job, **kwargs): 
+    def send_msg(cls, msg_type, reply, job, received_msg=None, **kwargs): 
 
         '''kwargs supplies the init variables to Message.create_messages() which call the following init functions based on the msg_type: 
         
@@ -73,6 +74,8 @@ class MessageSent(Message):
         For MessageForward, additional kwargs is required for seq_no and relation (min total 5 args)
 
         for template messages, sid and cv are passed through reply as a tuple
+
+        if received_msg is passed, its reply_sid is set to the new message. The message, its status and the reply_sid are written in a single commit
         '''
 
         if msg_type == messages['FORWARD']:
@@ -90,7 +93,8 @@ class MessageSent(Message):
                 to_no = job.root_user.sg_number # user number
             kwargs["is_expecting_reply"] = getattr(job, 'is_expecting_user_reply', False)
 
-        # Send the message
+        # Send the message, never while the job row is locked by an uncommitted next_seq_no
+        check_no_job_row_held(get_session())
         if isinstance(reply, tuple):
             sid, cv = reply
             logging.info(cv)
@@ -101,9 +105,14 @@ class MessageSent(Message):
         kwargs["job_no"] = job.job_no
         kwargs["sid"] = sent_message_meta.sid
 
-        sent_msg = Message.create_message(msg_type, **kwargs)
+        sent_msg = Message.build_message(msg_type, **kwargs)
+        sent_msg.status = PENDING_CALLBACK
+        if received_msg is not None:
+            received_msg.reply_sid = sent_msg.sid
 
-        sent_msg.commit_status(PENDING_CALLBACK)
+        session = get_session()
+        session.commit()
+        cls.logger.info(f"message {sent_msg.sid} committed with seq number {sent_msg.seq_no} and status {PENDING_CALLBACK}")
         return sent_msg
 
     @staticmethod
@@ -183,24 +192,54 @@ class MessageForward(MessageSent):
     
     @classmethod
     def forward_template_msges(cls, job):
-        '''Ensure the job has the following attributes: cv_and_users_list, content_sid (only needed for forward messages). It sets successful_forwards and forwards_seq_no'''
+        '''Ensure the job has the following attributes: cv_and_users_list, content_sid (only needed for forward messages). It sets successful_forwards and forwards_seq_no.
+
+        The Twilio requests go through a bounded thread pool, paced by twilio_rate_limiter, and the resulting MessageForwards are inserted in a single commit. Callbacks that arrive before that commit are stashed in Redis and handed back by Job.replay_callbacks'''
 
-        job.forwards_seq_no = MessageSent.get_seq_no(job.job_no) + 1
+        session = get_session()
+        job.forwards_seq_no = MessageSent.next_seq_no(job.job_no)
+        session.commit() # releases the job row locked by next_seq_no before the fan out, callbacks touching the job would wait on it otherwise
         job.successful_forwards = []
 
-        for content_variables, to_user in job.cv_and_users_list:
-            try:
-                cls.send_msg(
-                    msg_type=messages['FORWARD'],
-                    reply=(job.content_sid, content_variables), 
-                    job=job, 
-                    seq_no=job.forwards_seq_no,
-                    to_user=to_user
-                )
+        if not job.cv_and_users_list:
+            return
+
+        is_expecting_reply = getattr(job, 'is_expecting_relations_reply', False)
+
+        def send(content_variables, to_no):
+            twilio_rate_limiter.wait()
+            return cls._send_template_msg(job.content_sid, content_variables, to_no)
+
+        new_forwards = []
+
+        # only the Twilio requests run in the pool, the ORM objects stay in this thread
+        with ThreadPoolExecutor(max_workers=min(FORWARD_MAX_WORKERS, len(job.cv_and_users_list))) as executor:
+            futures = [
+                (to_user, executor.submit(send, content_variables, to_user.sg_number))
+                for content_variables, to_user in job.cv_and_users_list
+            ]
+
+            for to_user, future in futures:
+                try:
+                    sent_message_meta = future.result()
+                except Exception:
+                    cls.logger.error(traceback.format_exc())
+                    continue
+
+                forward = cls(job.job_no, sent_message_meta.sid, is_expecting_reply, job.forwards_seq_no, to_user)
+                forward.status = PENDING_CALLBACK
+                new_forwards.append(forward)
                 job.successful_forwards.append(to_user.name)
-            except Exception:
-                cls.logger.error(traceback.format_exc())
-                continue
+
+        session.add_all(new_forwards)
+        session.commit()
+        cls.logger.info(f"{len(new_forwards)} of {len(job.cv_and_users_list)} forwards sent with seq no {job.forwards_seq_no}")
+
+        early_callbacks = current_app.redis_client.pop_early_callbacks([forward.sid for forward in new_forwards])
+        if early_callbacks:
+            from models.jobs.abstract import Job
+            cls.logger.info(f"replaying {len(early_callbacks)} callbacks received before the forwards were committed")
+            Job.replay_callbacks(early_callbacks)
 
     #################################
     # CV TEMPLATES FOR MANY MESSAGES
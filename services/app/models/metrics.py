@@ -20,6 +20,8 @@ class Metric(db.Model):
     last_successful_update = db.Column(db.DateTime(timezone=True), default=None, nullable=True)
     last_job_no = db.Column(db.ForeignKey("job.job_no"), nullable = True)
     last_successful_job_no = db.Column(db.ForeignKey("job.job_no"), nullable = True)
+    last_seen_tag = db.Column(db.String(120), default=None, nullable=True) # cTag of the source workbook at the last successful sync, see JobSyncUsers
+    last_catch_up = db.Column(db.DateTime(timezone=True), default=None, nullable=True) # when the scheduler last ran the job because its scheduled run was missed, see tasks.missed_jobs
 
     def __init__(self, _type):
         session = get_session()
@@ -35,9 +37,11 @@ class Metric(db.Model):
             metric = cls(METRIC_MAPPING[_type])
         return metric
     
-    def set_metric_start(self):
+    def set_metric_start(self, catch_up=False):
         session = get_session()
         self.status = PROCESSING
+        if catch_up:
+            self.last_catch_up = current_sg_time()
         session.commit()
 
     def set_metric_status(self, job):
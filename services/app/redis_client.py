@@ -4,19 +4,137 @@ from logs.config import setup_logger
 from constants import PROCESSING, PENDING_USER_REPLY
 from concurrent.futures import ThreadPoolExecutor
 from models.jobs.user.abstract import JobUser
-from models.exceptions import ReplyError
+from models.exceptions import ReplyError, LockTimeoutError
 from models.users import User
-from constants import errors
+from constants import errors, CALLBACK_STATUS_RANK
 import redis
 import traceback
+import time
+import uuid
+import threading
+from counters import counters
+from extensions import commit_count
+
+_connection_pools = {}
+_connection_pools_lock = threading.Lock()
+
+def get_connection_pool(url):
+    '''One Redis connection pool per url for the whole process'''
+    with _connection_pools_lock:
+        if url not in _connection_pools:
+            _connection_pools[url] = redis.ConnectionPool.from_url(url)
+            counters.incr("registry.redis_pools_created")
+        return _connection_pools[url]
+
+class RedisLock():
+    '''
+    Lock shared by every process through Redis. The key expires after ttl seconds in case the holder dies. While it is held a thread renews it every ttl / 3 seconds, so a holder that works longer than ttl keeps it.
+
+    There is no fencing: a holder cut off from Redis for longer than ttl loses the lock while it may still be working, so the work guarded by it should be safe to repeat, as the job status updates are.
+
+    Blocks with exponential backoff for up to timeout seconds when used as a context manager, raising LockTimeoutError afterwards
+    '''
+
+    # only delete the key if it still holds our token, otherwise a lock that expired and was taken by someone else would be released
+    release_script = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+
+    # only extend the key while it still holds our token
+    renew_script = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+
+    def __init__(self, client, name, ttl=60, timeout=30):
+        self.client = client
+        self.name = name
+        self.key = f"lock:{name}"
+        self.ttl = ttl
+        self.timeout = timeout
+        self.token = None
+        self._released = None
+
+    def acquire(self, blocking=True):
+        start = time.monotonic()
+        delay = 0.05
+        token = uuid.uuid4().hex
+
+        while True:
+            if self.client.set(self.key, token, nx=True, px=int(self.ttl * 1000)):
+                self.token = token
+                self._released = threading.Event()
+                threading.Thread(target=self._renew, args=(token, self._released), daemon=True).start()
+                counters.incr("lock.acquired")
+                counters.observe("lock.wait_seconds", time.monotonic() - start)
+                return True
+
+            remaining = self.timeout - (time.monotonic() - start)
+            if not blocking or remaining <= 0:
+                counters.incr("lock.timeouts")
+                return False
+
+            counters.incr("lock.contended_attempts")
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 1)
+
+    def _renew(self, token, released):
+        while not released.wait(self.ttl / 3):
+            try:
+                if not self.client.eval(self.renew_script, 1, self.key, token, int(self.ttl * 1000)):
+                    counters.incr("lock.lost")
+                    return
+            except redis.RedisError:
+                counters.incr("lock.renew_errors") # retried on the next tick, the key lasts until ttl
+
+    def release(self):
+        '''
+        A Redis error is logged rather than raised, the key expires after ttl anyway, and __exit__ would otherwise replace the exception of the locked block
+        '''
+        if self.token:
+            self._released.set()
+            try:
+                self.client.eval(self.release_script, 1, self.key, self.token)
+            except redis.RedisError:
+                counters.incr("lock.release_errors")
+                logging.error(f"could not release {self.key}, it expires in {self.ttl}s: {traceback.format_exc()}")
+            finally:
+                self.token = None
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockTimeoutError(f"Could not acquire {self.key} within {self.timeout}s")
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.release()
 
 class Redis():
 
     logger = setup_logger('models.redis')
 
-    def __init__(self, url, cipher_suite):
-        self.client = redis.Redis.from_url(url)
+    # user ids whose queue has work waiting, drained by worker.py when async_jobs is set
+    ready_queue = "user_jobs_ready"
+
+    # Twilio status callbacks, applied in batches by worker.py when async_callbacks is set
+    callback_stream = "message_callbacks"
+    callback_group = "callback_appliers"
+    callback_stream_maxlen = 10000
+    early_callback_ttl = 300
+
+    def __init__(self, url, cipher_suite, async_jobs=False, async_callbacks=False):
+        self.client = redis.Redis(connection_pool=get_connection_pool(url))
         self.cipher_suite = cipher_suite
+        self.async_jobs = async_jobs
+        self.async_callbacks = async_callbacks
+
+    def lock(self, name, ttl=60, timeout=30):
+        return RedisLock(self.client, name, ttl=ttl, timeout=timeout)
 
     def get_last_job_info(self, user_id):
         encrypted_data = self.client.hget(f"user_job_data:{user_id}", "job_information")
@@ -103,39 +221,64 @@ class Redis():
 
         possible jobs that have been enqueued: reply messages, new messages sent when no other job running or job pending
         '''
-        # Check no job running
-        if not self.client.get(f"user_job:{user_id}"):
-
-            # check for pending job
-            last_job_info = self.get_last_job_info(user_id)
-            # new message must be a reply. dont start job if its not pending reply; the callback will start it
-            if last_job_info and last_job_info['status'] != PENDING_USER_REPLY: 
-                return None
-            
-            # msg must be completely new / last job exists and is pending reply / user double clicks but the last_job_info has been deleted
-            else:
-                logging.info(f"start next job user_id: {user_id}")
-                job_info_raw = self.client.lpop(f"user_jobs_queue:{user_id}")
-                if job_info_raw:
-                    new_job_info = json.loads(job_info_raw)
-                    
-                    if last_job_info:
-                        new_job_info.update(last_job_info)  # Assuming you want to update/merge it
-                    logging.info(f"Combined job info dict: {new_job_info}")
-
-                    # Proceed with setting the job in progress and starting it
-                    self.client.set(f"user_job:{user_id}", "in_progress", ex=JobUser.max_pending_duration)
-
-                    logging.info("JOB STARTED")
-                    job_info = JobUser.general_workflow(new_job_info)
-                    self.job_completed(job_info, user_id)  # Assuming job_completed does not require parameters, or pass them if it does
-
-                    return "job started", new_job_info
-        # If there's already an job in progress or no jobs in the queue
-        else:
+        # read only checks first, a claim taken and dropped again here would make a concurrent enqueue_job for the user raise DOUBLE_MESSAGE
+        if self.client.exists(f"user_job:{user_id}"):
+            logging.info("JOB NOT READY TO START")
+            return None
+
+        # check for pending job
+        last_job_info = self.get_last_job_info(user_id)
+        # new message must be a reply. dont start job if its not pending reply; the callback will start it
+        if last_job_info and last_job_info['status'] != PENDING_USER_REPLY:
+            return None
+
+        if not self.client.llen(f"user_jobs_queue:{user_id}"):
+            return None
+
+        # msg must be completely new / last job exists and is pending reply / user double clicks but the last_job_info has been deleted
+        # claim the user in one step, so that several workers cannot start jobs for the same user
+        if not self.client.set(f"user_job:{user_id}", "in_progress", nx=True, ex=JobUser.max_pending_duration):
             logging.info("JOB NOT READY TO START")
             return None
 
+        logging.info(f"start next job user_id: {user_id}")
+        # read again under the claim, a job may have finished since the checks above
+        last_job_info = self.get_last_job_info(user_id)
+        job_info_raw = self.client.lpop(f"user_jobs_queue:{user_id}") if not last_job_info or last_job_info['status'] == PENDING_USER_REPLY else None
+        if not job_info_raw:
+            # another worker started the queued job or the last job is no longer pending a reply, release the claim
+            self.client.delete(f"user_job:{user_id}")
+            return None
+
+        new_job_info = json.loads(job_info_raw)
+
+        if last_job_info:
+            new_job_info.update(last_job_info)  # Assuming you want to update/merge it
+        logging.info(f"Combined job info dict: {new_job_info}")
+
+        logging.info("JOB STARTED")
+        commits_before = commit_count()
+        job_info = JobUser.general_workflow(new_job_info)
+        counters.observe("commits_per_inbound_message", commit_count() - commits_before)
+        self.job_completed(job_info, user_id)  # Assuming job_completed does not require parameters, or pass them if it does
+
+        return "job started", new_job_info
+
+    def dispatch_next_job(self, user_id):
+        '''Hands the user over to the worker pool in async mode, otherwise runs the next job in the calling thread'''
+        if self.async_jobs:
+            self.client.rpush(self.ready_queue, user_id)
+            logging.info(f"user {user_id} dispatched to workers")
+            return None
+        return self.start_next_job(user_id)
+
+    def wait_for_ready_user(self, timeout=5):
+        '''Blocks until a user has queued work, used by worker.py. Returns the user_id or None on timeout'''
+        item = self.client.blpop(self.ready_queue, timeout=timeout)
+        if item:
+            return item[1].decode()
+        return None
+
     def update_job_status(self, user_id, message):
         '''updates job status to pending user reply in the cache as soon as the callback has been confirmed'''
         encrypted_data = self.client.hget(f"user_job_data:{user_id}", "job_information")
@@ -152,4 +295,84 @@ class Redis():
                     updated_data_json = json.dumps(last_job_info)
                     encrypted_updated_data = self.cipher_suite.encrypt(updated_data_json.encode())
                     self.client.hset(f"user_job_data:{user_id}", "job_information", encrypted_updated_data)
-                    self.start_next_job(user_id)
\ No newline at end of file
+                    self.dispatch_next_job(user_id)
+
+    ###################################
+    # MESSAGE STATUS CALLBACKS
+    ###################################
+
+    def add_callback_event(self, sid, status, to_no):
+        '''appends a Twilio status callback to the stream, this is all the callback endpoint does in async mode'''
+        self.client.xadd(
+            self.callback_stream,
+            {"sid": sid, "status": status, "to": to_no or ""},
+            maxlen=self.callback_stream_maxlen,
+            approximate=True
+        )
+
+    def read_callback_events(self, consumer, count=200, block=1000, pending=False):
+        '''
+        Reads a batch of callbacks for this consumer as a list of (entry_id, fields).
+
+        With pending=True, it returns the entries this consumer read earlier but never acknowledged (eg. the applier crashed mid batch)
+        '''
+        try:
+            self.client.xgroup_create(self.callback_stream, self.callback_group, id="0", mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+        response = self.client.xreadgroup(
+            self.callback_group,
+            consumer,
+            {self.callback_stream: "0" if pending else ">"},
+            count=count,
+            block=None if pending else block
+        )
+
+        events = []
+        for _, entries in response:
+            for entry_id, fields in entries:
+                events.append((entry_id, {key.decode(): value.decode() for key, value in fields.items()}))
+        return events
+
+    def ack_callback_events(self, entry_ids):
+        if entry_ids:
+            self.client.xack(self.callback_stream, self.callback_group, *entry_ids)
+            self.client.xdel(self.callback_stream, *entry_ids)
+
+    def stash_early_callback(self, sid, status, to_no):
+        '''keeps a callback whose message is not committed yet, eg. forwards are only inserted once the whole fan out is sent'''
+        key = f"early_callbacks:{sid}"
+        pipe = self.client.pipeline()
+        pipe.rpush(key, json.dumps({"sid": sid, "status": status, "to": to_no or ""}))
+        pipe.expire(key, self.early_callback_ttl)
+        pipe.execute()
+
+    def pop_early_callbacks(self, sids):
+        '''returns the stashed callbacks of the sids as (entry_id, fields) like read_callback_events'''
+        pipe = self.client.pipeline()
+        for sid in sids:
+            pipe.lrange(f"early_callbacks:{sid}", 0, -1)
+            pipe.delete(f"early_callbacks:{sid}")
+        results = pipe.execute() if sids else []
+
+        events = []
+        for stashed in results[::2]:
+            events.extend((None, json.loads(event)) for event in stashed)
+        return events
+
+    @staticmethod
+    def coalesce_callbacks(events):
+        '''Keeps only the furthest status per sid. Whether a "sent" callback was seen is kept so that the message body is still fetched'''
+        callbacks = {}
+        for _, event in events:
+            status = event['status']
+            if status not in CALLBACK_STATUS_RANK:
+                continue
+            callback = callbacks.setdefault(event['sid'], {"status": status, "to": event['to'], "sent": False})
+            if CALLBACK_STATUS_RANK[status] > CALLBACK_STATUS_RANK[callback['status']]:
+                callback['status'] = status
+            if status == "sent":
+                callback['sent'] = True
+        return callbacks
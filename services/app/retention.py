@@ -0,0 +1,245 @@
+'''
+Deletes old rows of the job table, its subclass tables and the messages of those jobs, in batches, per job type. The jobs of the types with archive set are written to gzipped json lines under RETENTION_ARCHIVE_DIR before they are deleted:
+
+    python -m retention [--dry-run] [--type job_es] [--batch-size 500] [--max-seconds 600]
+
+The morning report run of tasks.py calls run_retention with a time budget, the first run over a large backlog is better done from here. A job still referenced from outside its own rows (eg. by metrics or leave_records) is kept
+'''
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import time
+import traceback
+from datetime import timedelta
+
+from sqlalchemy import select, delete, tuple_
+from sqlalchemy.exc import IntegrityError
+
+from counters import counters
+from extensions import db, get_session
+from utilities import current_sg_time
+
+# job type: days a job is kept, and whether its rows and messages are archived before they are deleted. Types not listed are never deleted. RETENTION_DAYS overrides the days, eg. RETENTION_DAYS=job_acq_token=7,job_es=180
+RETENTION_POLICIES = {
+    "job_system": {"days": 30, "archive": False}, # the main job tasks.main creates on every run
+    "job_acq_token": {"days": 30, "archive": False},
+    "job_sync_users": {"days": 30, "archive": False},
+    "job_sync_records": {"days": 90, "archive": False},
+    "job_am_report": {"days": 180, "archive": False},
+    "job_user": {"days": 365, "archive": True}, # messages without a recognised intent
+    "job_es": {"days": 365, "archive": True},
+    "job_unknown": {"days": 365, "archive": True},
+    "job_leave": {"days": 365, "archive": True},
+    "job_leave_cancel": {"days": 365, "archive": True},
+}
+
+BATCH_SIZE = 500 # jobs deleted per transaction
+SCHEDULED_MAX_SECONDS = 60 # budget of the run with the morning report, the rest is picked up the next day
+
+ARCHIVE_DIR = os.getenv("RETENTION_ARCHIVE_DIR", "/var/lib/chatbot/archive")
+
+def get_policies():
+    policies = {_type: dict(policy) for _type, policy in RETENTION_POLICIES.items()}
+    for override in filter(None, os.getenv("RETENTION_DAYS", "").split(",")):
+        _type, _, days = override.partition("=")
+        if _type.strip() in policies:
+            policies[_type.strip()]["days"] = int(days)
+        else:
+            logging.warning(f"RETENTION_DAYS: no retention policy for {_type}")
+    return policies
+
+def dependency_order(tables):
+    '''tables in the order they are created, parents first'''
+    tables = set(tables)
+    return [table for table in db.metadata.sorted_tables if table in tables]
+
+def inheritance_tables(model, *identities):
+    '''the tables the rows of the polymorphic identities span, base table first'''
+    return dependency_order(table for identity in identities for table in model.__mapper__.polymorphic_map[identity].tables)
+
+def message_tables():
+    from models.messages.abstract import Message
+    return {table for mapper in Message.__mapper__.polymorphic_map.values() for table in mapper.tables}
+
+def protecting_columns(tables):
+    '''
+    Columns outside tables and the message tables with a foreign key into tables. A job referenced by one of them is kept.
+
+    The primary key to primary key links of joined inheritance are left out, the subclass tables of other identities never hold this identity's jobs
+    '''
+    skip = set(tables) | message_tables()
+    return [
+        fk.parent
+        for table in db.metadata.sorted_tables if table not in skip
+        for fk in table.foreign_keys if fk.column.table in tables and not (fk.parent.primary_key and fk.column.primary_key)
+    ]
+
+class RetentionRun:
+    '''Deletes the jobs of one type older than its policy, batch by batch in (created_at, job_no) order, one transaction per batch'''
+
+    def __init__(self, identity, policy, batch_size=BATCH_SIZE, deadline=None, dry_run=False):
+        from models.jobs.abstract import Job
+
+        self.session = get_session()
+        self.identity = identity
+        self.policy = policy
+        self.batch_size = batch_size
+        self.deadline = deadline
+        self.dry_run = dry_run
+
+        self.job = Job.__table__
+        self.tables = inheritance_tables(Job, identity)
+        self.protecting = protecting_columns(self.tables)
+        self.archive_file = None
+
+        self.report = {"jobs": 0, "kept": 0, "failed": 0, "archived": 0, "rows": {}, "seconds": 0, "finished": False}
+
+    def run(self):
+        start = time.monotonic()
+        threshold = current_sg_time() - timedelta(days=self.policy["days"])
+        cursor = None
+
+        try:
+            while True:
+                if self.deadline and time.monotonic() > self.deadline:
+                    logging.info(f"retention of {self.identity} stopped at its time budget")
+                    break
+
+                stmt = select(self.job.c.created_at, self.job.c.job_no).where(self.job.c.type == self.identity, self.job.c.created_at < threshold)
+                if cursor:
+                    stmt = stmt.where(tuple_(self.job.c.created_at, self.job.c.job_no) > cursor)
+                rows = self.session.execute(stmt.order_by(self.job.c.created_at, self.job.c.job_no).limit(self.batch_size)).all()
+                if not rows:
+                    self.report["finished"] = True
+                    break
+                cursor = tuple(rows[-1])
+
+                self.delete_batch([row.job_no for row in rows])
+        finally:
+            if self.archive_file:
+                self.archive_file.close()
+
+        self.report["seconds"] = round(time.monotonic() - start, 2)
+        return self.report
+
+    def delete_batch(self, job_nos):
+        protected = set()
+        for column in self.protecting:
+            protected.update(self.session.execute(select(column).where(column.in_(job_nos))).scalars())
+        job_nos = [job_no for job_no in job_nos if job_no not in protected]
+        self.report["kept"] += len(protected)
+
+        if not job_nos:
+            return
+
+        try:
+            self.delete_in_savepoint(job_nos)
+        except IntegrityError:
+            # a reference the metadata does not know about, eg. a message of another job. Retried one job at a time so the rest of the batch still goes
+            logging.error(traceback.format_exc())
+            for job_no in job_nos:
+                try:
+                    self.delete_in_savepoint([job_no])
+                except IntegrityError:
+                    logging.error(f"retention could not delete {self.identity} {job_no}")
+                    self.report["failed"] += 1
+        self.session.commit()
+
+    def delete_in_savepoint(self, job_nos):
+        '''the savepoint is rolled back on a dry run, the archive is written once it is released'''
+        savepoint = self.session.begin_nested()
+        try:
+            rows, archived = self.delete_jobs(job_nos)
+        except BaseException:
+            savepoint.rollback()
+            raise
+
+        if self.dry_run:
+            savepoint.rollback()
+        else:
+            savepoint.commit()
+            if archived:
+                self.archive(archived)
+
+        for name, count in rows.items():
+            self.report["rows"][name] = self.report["rows"].get(name, 0) + count
+            counters.incr("retention.rows_deleted", count)
+        self.report["jobs"] += len(job_nos)
+
+    def delete_jobs(self, job_nos):
+        '''deletes the jobs and their messages, returning the rows deleted per table and the rows to archive'''
+        from models.messages.abstract import Message
+
+        message = Message.__table__
+        messages = self.session.execute(select(message.c.sid, message.c.type).where(message.c.job_no.in_(job_nos))).all()
+        sids = [row.sid for row in messages]
+        # children before parents, message_confirm before message_received before message, and the messages before the job
+        tables = [(table, table.c.sid, sids) for table in reversed(inheritance_tables(Message, *{row.type for row in messages}))]
+        tables += [(table, table.c.job_no, job_nos) for table in reversed(self.tables)]
+
+        archived = []
+        if self.policy["archive"] and not self.dry_run:
+            for table, key, keys in reversed(tables):
+                archived.extend((table.name, row) for row in self.session.execute(select(table).where(key.in_(keys))).mappings())
+
+        rows = {}
+        for table, key, keys in tables:
+            if keys:
+                rows[table.name] = self.session.execute(delete(table).where(key.in_(keys))).rowcount
+        return rows, archived
+
+    def archive(self, rows):
+        '''written before the batch is committed, so a crash in between leaves a row archived twice rather than lost'''
+        if self.archive_file is None:
+            os.makedirs(ARCHIVE_DIR, exist_ok=True)
+            path = os.path.join(ARCHIVE_DIR, f"{self.identity}-{current_sg_time().strftime('%Y%m%d')}.jsonl.gz")
+            self.archive_file = gzip.open(path, "at", encoding="utf-8") # gzip members can be appended, the file reads as one stream
+        for table, row in rows:
+            self.archive_file.write(json.dumps({"table": table, "row": dict(row)}, default=str) + "\n")
+        self.archive_file.flush()
+        self.report["archived"] += len(rows)
+
+def run_retention(types=None, batch_size=BATCH_SIZE, max_seconds=None, dry_run=False):
+    '''Runs the policies of types, or of every type, in the current app context. Returns {type: report}'''
+    deadline = time.monotonic() + max_seconds if max_seconds else None
+    reports = {}
+
+    for identity, policy in get_policies().items():
+        if types and identity not in types:
+            continue
+        if deadline and time.monotonic() > deadline:
+            break
+        reports[identity] = RetentionRun(identity, policy, batch_size=batch_size, deadline=deadline, dry_run=dry_run).run()
+        logging.info(f"retention of {identity}: {reports[identity]}")
+
+    return reports
+
+def format_report(reports):
+    lines = []
+    for identity, report in reports.items():
+        rows = ", ".join(f"{name} {count}" for name, count in report["rows"].items()) or "none"
+        lines.append(
+            f"{identity:18} {report['jobs']:6} jobs in {report['seconds']:7.2f}s, kept {report['kept']}, failed {report['failed']}, "
+            f"archived {report['archived']} rows{'' if report['finished'] else ', not finished'}\n{'':18} rows: {rows}"
+        )
+    lines.append(f"total: {sum(sum(report['rows'].values()) for report in reports.values())} rows in {sum(report['seconds'] for report in reports.values()):.2f}s")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path="/etc/environment")
+    from manage import get_app
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="count what would be deleted, nothing is deleted or archived")
+    parser.add_argument("--type", action="append", dest="types", choices=sorted(RETENTION_POLICIES), help="only this job type, can be repeated")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--max-seconds", type=float, default=None)
+    args = parser.parse_args()
+
+    with get_app().app_context():
+        reports = run_retention(args.types, batch_size=args.batch_size, max_seconds=args.max_seconds, dry_run=args.dry_run)
+    print(format_report(reports))
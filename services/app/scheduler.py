@@ -0,0 +1,112 @@
+from dotenv import load_dotenv
+env_path = f"/etc/environment"
+load_dotenv(dotenv_path=env_path)
+
+import logging
+import sys
+import time
+import traceback
+from datetime import timedelta
+
+import tasks
+from constants import system
+from manage import get_app
+from utilities import current_sg_time, log_level
+
+logging.basicConfig(
+    filename='/var/log/scheduler.log',
+    filemode='a',
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=log_level
+)
+logging.getLogger('twilio.http_client').setLevel(logging.WARNING)
+
+NEXT_RUNS_KEY = "scheduler:next_runs"
+MAX_CATCH_UP = timedelta(minutes=60) # minutes missed while a run overran are still evaluated, up to this far back
+
+job_names = {value: key for key, value in system.items()}
+
+def next_runs(after):
+    return {job_names[_type]: tasks.next_run(_type, after) for _type in tasks.JOBS}
+
+def publish_next_runs(app, after):
+    '''keeps the next run of every job in the scheduler:next_runs hash, read by python -m scheduler next'''
+    runs = {name: run.isoformat() for name, run in next_runs(after).items() if run}
+    try:
+        app.redis_client.client.hset(NEXT_RUNS_KEY, mapping=runs)
+    except Exception:
+        logging.error(traceback.format_exc())
+
+def due_since(last_minute, minute):
+    '''every job due in the minutes after last_minute up to and including minute, in JOBS order'''
+    start = max(last_minute + timedelta(minutes=1), minute - MAX_CATCH_UP) if last_minute else minute
+    due = set()
+    send_message = False
+    while start <= minute:
+        due_now = tasks.due_jobs(start)
+        due.update(due_now)
+        send_message = send_message or system["AM_REPORT"] in due_now
+        start += timedelta(minutes=1)
+    return [_type for _type in tasks.JOBS if _type in due], send_message
+
+def catch_up_jobs(app, minute, jobs_to_run):
+    '''the jobs missed while the scheduler was down (see tasks.missed_jobs) which are not already due this minute'''
+    try:
+        with app.app_context():
+            missed = tasks.missed_jobs(minute - timedelta(minutes=1))
+    except Exception:
+        logging.error(traceback.format_exc())
+        return []
+    return [_type for _type in missed if _type not in jobs_to_run]
+
+def run_scheduler(app):
+    '''
+    Evaluates tasks.SCHEDULE once a minute in one long running process, so the app, engine, Redis pool and Graph session stay warm between runs instead of being rebuilt by a new python -m tasks every minute.
+
+    When a run overruns into the next minutes, the jobs due in the minutes it covered are run straight after it rather than skipped. When the scheduler starts, a job whose last scheduled run was missed while it was down is run once with the first minute
+    '''
+    logging.info("scheduler started")
+    last_minute = None
+
+    while True:
+        minute = current_sg_time().replace(second=0, microsecond=0)
+
+        if minute != last_minute:
+            catch_up = []
+            jobs_to_run, send_message = due_since(last_minute, minute)
+            if last_minute is None:
+                catch_up = catch_up_jobs(app, minute, jobs_to_run)
+                if catch_up:
+                    logging.info(f"catching up on {[job_names[_type] for _type in catch_up]}")
+                    send_message = send_message or system["AM_REPORT"] in catch_up
+                    jobs_to_run = [_type for _type in tasks.JOBS if _type in jobs_to_run or _type in catch_up]
+            last_minute = minute
+            publish_next_runs(app, minute)
+
+            if jobs_to_run:
+                logging.info(f"running {[job_names[_type] for _type in jobs_to_run]} for {minute}")
+                try:
+                    tasks.main(jobs_to_run, send_message=send_message, catch_up=catch_up)
+                except Exception:
+                    logging.error(traceback.format_exc())
+                continue # the run may have taken past the next minute
+
+        # wake up just after the next minute starts
+        now = current_sg_time()
+        time.sleep(60 - now.second - now.microsecond / 1e6 + 0.1)
+
+def print_next_runs(app):
+    try:
+        published = {key.decode(): value.decode() for key, value in app.redis_client.client.hgetall(NEXT_RUNS_KEY).items()}
+    except Exception:
+        published = {}
+
+    for name, run in next_runs(current_sg_time()).items():
+        print(f"{name:20} {run.strftime('%d-%m-%Y %H:%M') if run else 'NIL':20} published: {published.get(name, 'NIL')}")
+
+if __name__ == "__main__":
+    app = get_app()
+    if len(sys.argv) > 1 and sys.argv[1] == "next":
+        print_next_runs(app)
+    else:
+        run_scheduler(app)
@@ -1,106 +1,286 @@
-from dotenv import load_dotenv
-env_path = f"/etc/environment"
-load_dotenv(dotenv_path=env_path)
-
-from manage import create_app
-from constants import system
-from models.jobs.system.abstract import JobSystem
-from constants import messages
-from extensions import init_thread_session, get_session, remove_thread_session
-
-from models.messages.sent import MessageSent
-from models.exceptions import AzureSyncError
-from utilities import current_sg_time, convert_utc_to_sg_tz
-from constants import OK, SERVER_ERROR, PROCESSING
-from logs.config import setup_logger
+# only the standard library and constants (which imports nothing) are loaded up front, so a minute with nothing due returns before the app is imported. See benchmarks/import_time.py
 import logging
 import traceback
-from sqlalchemy import create_engine
 import os
 import json
-from models.metrics import Metric
+import time
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
 
-def main(jobs_to_run=[]):
+from constants import system, messages, OK, SERVER_ERROR
 
-    send_message = False
+singapore_tz = ZoneInfo('Asia/Singapore')
 
-    jobs = [system["ACQUIRE_TOKEN"], system["SYNC_USERS"], system["SYNC_LEAVE_RECORDS"], system["AM_REPORT"]]
+# job type: whether it is due at a given minute (Singapore time). Every job due in the same minute runs in one main() call, in the order of JOBS
+SCHEDULE = {
+    system["ACQUIRE_TOKEN"]: lambda dt: dt.minute % 30 == 0,
+    system["SYNC_USERS"]: lambda dt: dt.minute % 15 == 0, # this should be more regular than acquire
+    system["SYNC_LEAVE_RECORDS"]: lambda dt: dt.minute % 15 == 0,
+    system["AM_REPORT"]: lambda dt: dt.minute == 0 and dt.hour == 9 and dt.weekday() not in [5, 6],
+}
 
-    if len(jobs_to_run) == 0:
+JOBS = [system["ACQUIRE_TOKEN"], system["SYNC_USERS"], system["SYNC_LEAVE_RECORDS"], system["AM_REPORT"]]
 
-        cur_datetime = current_sg_time()
-        logging.info(cur_datetime)
+def due_jobs(dt):
+    return [_type for _type in JOBS if SCHEDULE[_type](dt)]
 
-        minute = cur_datetime.minute
+def next_run(_type, after, horizon=timedelta(days=8)):
+    '''the first minute after `after` at which _type is due, None if it is not due within horizon'''
+    dt = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    end = after + horizon
+    while dt <= end:
+        if SCHEDULE[_type](dt):
+            return dt
+        dt += timedelta(minutes=1)
+    return None
 
-        logging.info(f"{minute}, {cur_datetime.hour}")
+def previous_run(_type, before, horizon):
+    '''the last minute at or before `before` at which _type was due, None if it was not due within horizon'''
+    dt = before.replace(second=0, microsecond=0)
+    start = before - horizon
+    while dt >= start:
+        if SCHEDULE[_type](dt):
+            return dt
+        dt -= timedelta(minutes=1)
+    return None
 
-        if minute % 15 == 0:
-            jobs_to_run.append(system["SYNC_LEAVE_RECORDS"])
-            jobs_to_run.append(system["SYNC_USERS"]) # this should be more regular than acquire
+# how far back a scheduled run that never happened is still made up for when the scheduler starts. The morning report is not worth sending in the afternoon
+CATCH_UP_WINDOWS = {
+    system["ACQUIRE_TOKEN"]: timedelta(minutes=30),
+    system["SYNC_USERS"]: timedelta(minutes=15),
+    system["SYNC_LEAVE_RECORDS"]: timedelta(minutes=15),
+    system["AM_REPORT"]: timedelta(hours=3),
+}
 
-            if minute % 30 == 0:
-                jobs_to_run.append(system["ACQUIRE_TOKEN"])
-            
-        if minute == 0 and cur_datetime.hour == 9 and cur_datetime.weekday() not in [5, 6]: # bool
-            send_message = True
-            jobs_to_run.append(system["AM_REPORT"])
+def missed_jobs(now):
+    '''
+    The jobs whose last scheduled run within CATCH_UP_WINDOWS has no Metric.last_update after it, in JOBS order. Needs an app context.
+
+    Used by the scheduler when it starts, so a run missed while it was down is made once rather than every missed minute, or not at all
+    '''
+    from models.metrics import Metric
+
+    missed = []
+    for _type in JOBS:
+        due = previous_run(_type, now, CATCH_UP_WINDOWS[_type])
+        if due is None:
+            continue
+        metric = Metric.get_metric(_type)
+        if metric.last_update is None or metric.last_update < due:
+            missed.append(_type)
+    return missed
+
+# jobs which wait for others when both are due. The rest run in parallel, each in its own thread session
+JOB_DEPENDENCIES = {
+    system["SYNC_USERS"]: [system["ACQUIRE_TOKEN"]],
+    system["SYNC_LEAVE_RECORDS"]: [system["ACQUIRE_TOKEN"]],
+    system["AM_REPORT"]: [system["ACQUIRE_TOKEN"]],
+}
+
+# seconds main waits for a job once its dependencies are done, after which it is reported as timed out. The thread cannot be stopped and still records its own status when it finishes
+JOB_TIMEOUTS = {
+    system["ACQUIRE_TOKEN"]: 60,
+    system["SYNC_USERS"]: 300,
+    system["SYNC_LEAVE_RECORDS"]: 600,
+    system["AM_REPORT"]: 300,
+}
+
+LEASE_TIMEOUT_FACTOR = 3 # a job's lease expires after this many times its timeout, in case the process holding it died
+
+def metric_summary(metric):
+    '''the last update and last successful update for the report'''
+    from utilities import convert_utc_to_sg_tz
+
+    last_update = getattr(metric, 'last_update', None)
+    last_successful_update = getattr(metric, 'last_successful_update', None)
+    return (
+        convert_utc_to_sg_tz(last_update, '%d-%m-%Y %H:%M:%S') if last_update else "NIL",
+        convert_utc_to_sg_tz(last_successful_update, '%d-%m-%Y %H:%M:%S') if last_successful_update else "NIL",
+    )
+
+def run_job(app, _type, dependencies=(), dependency_timeout=None, catch_up=False):
+    '''
+    Runs one system job in its own app context and thread session, after the futures in dependencies are done. It is skipped if a dependency failed or is not done within dependency_timeout seconds.
+
+    The job holds the Redis lease system_job:{_type} while it runs, so a run that overlaps the previous one, from a timed out thread, the cron path or another scheduler, is skipped instead. If Redis is down the job runs without it
+
+    Returns plain values, so no ORM object leaves the thread: the reply, whether the status report should be sent, the forwards to check, the metric summary and whether the job failed
+    '''
+    from concurrent.futures import wait
+    import redis
+    from models.jobs.system.abstract import JobSystem
+    from extensions import get_session, remove_thread_session
+    from models.exceptions import AzureSyncError
+    from models.metrics import Metric
+
+    done, not_done = wait(dependencies, timeout=dependency_timeout)
+    dependency_failed = bool(not_done) or any(future.exception() or future.result()[-1] for future in done)
+
+    with app.app_context():
+        session = get_session()
+        forwards = None
+
+        if dependency_failed:
+            logging.info(f"{_type} skipped, a job it depends on failed or timed out")
+            try:
+                return "Skipped (Dependency failed)", False, None, metric_summary(Metric.get_metric(_type)), True
+            finally:
+                remove_thread_session()
+
+        lease = app.redis_client.lock(f"system_job:{_type}", ttl=JOB_TIMEOUTS[_type] * LEASE_TIMEOUT_FACTOR, timeout=0)
+
+        try:
+            try:
+                leased = lease.acquire(blocking=False)
+            except redis.RedisError:
+                logging.error(traceback.format_exc())
+                leased, lease = True, None
+
+            if not leased:
+                logging.info(f"{_type} skipped, the previous run still holds its lease")
+                return "Skipped (Previous run in progress)", False, None, metric_summary(Metric.get_metric(_type)), False
+
+            job = JobSystem.create_job(_type)
+
+            try:
+                metric = Metric.get_metric(_type)
+                metric.set_metric_start(catch_up=catch_up)
+                job.main() # updated the _type statuses
+                if getattr(job, "forwards_seq_no", None):
+                    forwards = (job.job_no, job.forwards_seq_no, job.map_job_type())
+
+                logging.info(f"JOB FINISHED WITH REPLY {job.reply} and STATUS {job.status}")
+
+                if job.error == True:
+                    job.commit_status(SERVER_ERROR)
+                elif job.status != SERVER_ERROR:
+                    logging.info("JOB WAS SUCCESSFUL")
+                    job.commit_status(OK)
+
+                reply = job.reply
+
+            except AzureSyncError as e:
+                logging.error(traceback.format_exc())
+                session.rollback()
+                job.commit_status(SERVER_ERROR)
+                reply = f"Failed: {e.message}"
+
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                session.rollback()
+                job.commit_status(SERVER_ERROR)
+                reply = "Failed (Unknown Error)"
+
+            send_message = metric.set_metric_status(job)
+
+            try:
+                summary = metric_summary(metric)
+            except Exception as e:
+                session.rollback()
+                logging.error(traceback.format_exc())
+                summary = ("Failed (Unknown Error)", "Failed (Unknown Error)")
+
+            return reply, send_message, forwards, summary, job.status == SERVER_ERROR
+        finally:
+            if lease:
+                try:
+                    lease.release()
+                except redis.RedisError:
+                    logging.error(traceback.format_exc())
+            remove_thread_session()
+
+def main(jobs_to_run=None, send_message=False, catch_up=()):
+    '''
+    Runs jobs_to_run, or the jobs due this minute when it is not given. send_message sends the status report to the admins, which is also sent when a job's status changes. The scheduled runs send it with the morning report.
+
+    The jobs run concurrently through run_job, apart from JOB_DEPENDENCIES, and each gets JOB_TIMEOUTS seconds once its dependencies are done before it is reported as timed out. A job whose dependency failed or timed out is skipped rather than left waiting on it. The jobs in catch_up are recorded in Metric.last_catch_up
+    '''
+
+    jobs = JOBS
+
+    if jobs_to_run is None:
+
+        cur_datetime = datetime.now(singapore_tz)
+        logging.info(cur_datetime)
+
+        logging.info(f"{cur_datetime.minute}, {cur_datetime.hour}")
+
+        jobs_to_run = due_jobs(cur_datetime)
+        send_message = system["AM_REPORT"] in jobs_to_run # bool
 
     if len(jobs_to_run) == 0:
         return
 
-    app = create_app()
-    engine = create_engine(app.config['SQLALCHEMY_DATABASE_URI'])
-    init_thread_session(engine)
+    from dotenv import load_dotenv
+    load_dotenv(dotenv_path="/etc/environment")
+
+    from manage import get_app
+    from models.jobs.system.abstract import JobSystem
+    from extensions import get_session, remove_thread_session
+    from models.messages.sent import MessageSent
+    from models.metrics import Metric
+    from counters import counters
+
+    app = get_app()
     session = get_session()
 
     main_job = JobSystem.create_job(system['MAIN'])
     main_job.background_tasks = []
     cv = {}
 
-    if send_message: # Temporary
-        JobSystem.delete_old_jobs()
+    if send_message: # old jobs are cleared once a day with the morning report, see retention.py
+        from retention import run_retention, SCHEDULED_MAX_SECONDS
+        try:
+            run_retention(max_seconds=SCHEDULED_MAX_SECONDS)
+        except Exception:
+            session.rollback()
+            logging.error(traceback.format_exc())
+
+    executor = ThreadPoolExecutor(max_workers=len(jobs_to_run))
+    futures = {}
+    budgets = {} # seconds from now by which each job is done or given up on, its timeout after those of its dependencies
+    finished = {} # when main saw each job finish or gave up on it
+    start = time.monotonic()
+
+    for _type in jobs: # in order, so dependencies are submitted first
+        if _type not in jobs_to_run:
+            continue
+        dependencies = [dependency for dependency in JOB_DEPENDENCIES.get(_type, []) if dependency in futures]
+        dependency_timeout = max([budgets[dependency] for dependency in dependencies], default=0)
+        budgets[_type] = dependency_timeout + JOB_TIMEOUTS[_type]
+        futures[_type] = executor.submit(run_job, app, _type, [futures[dependency] for dependency in dependencies], dependency_timeout, _type in catch_up)
 
     for i, _type in enumerate(jobs, 1):
 
         cv_index = 1 + (i - 1) * 3 # arithmetic progression
         
         if _type in jobs_to_run:
-
-            with app.app_context():
-
-                job = JobSystem.create_job(_type)
-
-                try:
-                    metric = Metric.get_metric(_type)
-                    metric.set_metric_start()
-                    job.main() # updated the _type statuses
-                    if getattr(job, "forwards_seq_no", None):
-                        main_job.background_tasks.append([job.check_message_forwarded, (job.forwards_seq_no, job.map_job_type())])
-                        
-                    logging.info(f"JOB FINISHED WITH REPLY {job.reply} and STATUS {job.status}")
-
-                    if job.error == True:
-                        job.commit_status(SERVER_ERROR)
-                    elif job.status != SERVER_ERROR:
-                        logging.info("JOB WAS SUCCESSFUL")
-                        job.commit_status(OK)
-
-                    cv[str(cv_index)] = job.reply
-
-                except AzureSyncError as e:
-                    logging.error(traceback.format_exc())
-                    session.rollback()
-                    job.commit_status(SERVER_ERROR)
-                    cv[str(cv_index)] = f"Failed: {e.message}"
-
-                except Exception as e:
-                    logging.error(traceback.format_exc())
-                    session.rollback()
-                    job.commit_status(SERVER_ERROR)
-                    cv[str(cv_index)] = "Failed (Unknown Error)"
-                
-                send_message = metric.set_metric_status(job) or send_message
+            # dependencies come earlier in JOBS, so they are already in finished
+            deadline = max([finished[dependency] for dependency in JOB_DEPENDENCIES.get(_type, []) if dependency in finished], default=start) + JOB_TIMEOUTS[_type]
+            try:
+                reply, job_send_message, forwards, summary, _ = futures[_type].result(timeout=max(0, deadline - time.monotonic()))
+                finished[_type] = time.monotonic()
+                cv[str(cv_index)] = reply
+                cv[str(cv_index + 1)], cv[str(cv_index + 2)] = summary
+                send_message = job_send_message or send_message
+                if forwards:
+                    job_no, seq_no, job_type = forwards
+                    job = session.get(JobSystem, job_no)
+                    main_job.background_tasks.append([job.check_message_forwarded, (seq_no, job_type)])
+                continue
+            except concurrent.futures.TimeoutError:
+                finished[_type] = time.monotonic()
+                logging.error(f"{_type} did not finish within its timeout")
+                cv[str(cv_index)] = "Failed (Timed out)"
+                send_message = True
+            except Exception as e:
+                finished[_type] = time.monotonic()
+                logging.error(traceback.format_exc())
+                cv[str(cv_index)] = "Failed (Unknown Error)"
+                send_message = True
+            metric = Metric.get_metric(_type)
         else:
             metric = Metric.get_metric(_type)
             if metric.status == OK:
@@ -111,23 +291,16 @@ def main(jobs_to_run=[]):
                 cv[str(cv_index)] = "Failed"
 
         try:
-            last_update = getattr(metric, 'last_update', None)
-            if not last_update:
-                cv[str(cv_index + 1)] = "NIL"
-            else:
-                cv[str(cv_index + 1)] = convert_utc_to_sg_tz(metric.last_update, '%d-%m-%Y %H:%M:%S')
-
-            last_successful_update = getattr(metric, 'last_successful_update', None)
-            if not last_successful_update:
-                cv[str(cv_index + 2)] = "NIL"
-            else:
-                cv[str(cv_index + 2)] = convert_utc_to_sg_tz(metric.last_successful_update, '%d-%m-%Y %H:%M:%S')
+            cv[str(cv_index + 1)], cv[str(cv_index + 2)] = metric_summary(metric)
         except Exception as e:
             session.rollback()
             logging.error(traceback.format_exc())
             cv[str(cv_index + 1)] = "Failed (Unknown Error)"
             cv[str(cv_index + 2)] = "Failed (Unknown Error)"
 
+    # a timed out job keeps its thread, which is not waited for here
+    executor.shutdown(wait=False)
+
     if send_message:
         cv = json.dumps(cv)
         content_sid = os.environ.get('SEND_SYSTEM_TASKS_SID')
@@ -137,7 +310,7 @@ def main(jobs_to_run=[]):
 
     remove_thread_session()
 
-    logging.info("Tasks complete")
+    logging.info(f"Tasks complete, counters: {counters.snapshot()}")
             
 if __name__ == "__main__":
     main()
@@ -0,0 +1,120 @@
+'''
+RetentionRun against an SQLite copy of the schema, run from services/app with python -m pytest tests or python -m unittest discover tests.
+
+The models create the Twilio client when they are imported, so placeholder credentials are set if the environment has none
+'''
+
+import gzip
+import json
+import os
+import tempfile
+import unittest
+from datetime import date, timedelta
+
+os.environ.setdefault("TWILIO_ACCOUNT_SID", "ACtest")
+os.environ.setdefault("TWILIO_AUTH_TOKEN", "test")
+
+from sqlalchemy import create_engine, insert, select, func
+
+import extensions
+from extensions import db, init_thread_session, get_session
+import models.jobs.system.acq_token, models.jobs.system.sync_users, models.jobs.system.am_report, models.jobs.system.sync_leave_records
+import models.jobs.user.leave, models.jobs.user.es, models.jobs.unknown.unknown
+import models.metrics, models.leave_records
+import retention
+from utilities import current_sg_time
+
+def table(name):
+    return db.metadata.tables[name]
+
+class RetentionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = create_engine("sqlite://")
+        db.metadata.create_all(self.engine)
+        extensions.ThreadSession = None
+        init_thread_session(self.engine)
+        self.session = get_session()
+        self.old = current_sg_time() - timedelta(days=400)
+
+        self.add_job("main1", "job_system", ["job_system"])
+        self.add_job("main2", "job_system", ["job_system"], created_at=current_sg_time())
+        self.add_job("tok1", "job_acq_token", ["job_system", "job_acq_token"])
+        self.add_job("tok2", "job_acq_token", ["job_system", "job_acq_token"])
+        self.session.execute(insert(table("metrics")).values(_type="acq_token", last_job_no="tok2"))
+
+        self.add_job("other1", "job_user", ["job_user"])
+        self.add_message("m1", "other1", "message_received", ["message_received"])
+        self.add_message("m2", "other1", "message_confirm", ["message_received", "message_confirm"], ref_msg_sid="m1", _decision=1)
+
+        self.add_job("leave1", "job_leave", ["job_user", "job_leave"])
+        self.session.execute(insert(table("leave_records")).values(id="r1", job_no="leave1", date=date.today(), sync_status=1, is_cancelled=False))
+        self.session.commit()
+
+        self.archive_dir = tempfile.TemporaryDirectory()
+        self.archive_dir_default = retention.ARCHIVE_DIR
+        retention.ARCHIVE_DIR = self.archive_dir.name
+
+    def tearDown(self):
+        retention.ARCHIVE_DIR = self.archive_dir_default
+        self.archive_dir.cleanup()
+        extensions.remove_thread_session()
+        self.engine.dispose()
+
+    def add_job(self, job_no, _type, tables, created_at=None):
+        self.session.execute(insert(table("job")).values(job_no=job_no, type=_type, status=200, created_at=created_at or self.old, locked=False, last_seq_no=0))
+        columns = {
+            "job_user": {"name": "Alice", "is_cancelled": False},
+            "job_leave": {"local_db_updated": False},
+        }
+        for name in tables:
+            self.session.execute(insert(table(name)).values(job_no=job_no, **columns.get(name, {})))
+
+    def add_message(self, sid, job_no, _type, tables, **columns):
+        self.session.execute(insert(table("message")).values(sid=sid, type=_type, body="hi", timestamp=self.old, seq_no=1, job_no=job_no))
+        for name in tables:
+            self.session.execute(insert(table(name)).values(sid=sid, **(columns if name == "message_confirm" else {})))
+
+    def job_nos(self):
+        return set(self.session.execute(select(table("job").c.job_no)).scalars())
+
+    def count(self, name):
+        return self.session.scalar(select(func.count()).select_from(table(name)))
+
+    def test_every_created_identity_has_a_policy(self):
+        for identity in ["job_system", "job_acq_token", "job_sync_users", "job_sync_records", "job_am_report", "job_user", "job_es", "job_unknown", "job_leave", "job_leave_cancel"]:
+            self.assertIn(identity, retention.RETENTION_POLICIES)
+
+    def test_dry_run_counts_without_deleting(self):
+        reports = retention.run_retention(batch_size=1, dry_run=True)
+
+        self.assertEqual(reports["job_system"]["jobs"], 1)
+        self.assertEqual(reports["job_system"]["rows"], {"job_system": 1, "job": 1})
+        self.assertEqual(reports["job_acq_token"]["jobs"], 1)
+        self.assertEqual(reports["job_acq_token"]["kept"], 1)
+        self.assertEqual(reports["job_user"]["rows"], {"message_confirm": 1, "message_received": 2, "message": 2, "job_user": 1, "job": 1})
+        self.assertEqual(reports["job_leave"]["kept"], 1)
+        self.assertEqual(reports["job_user"]["archived"], 0)
+
+        self.assertEqual(self.job_nos(), {"main1", "main2", "tok1", "tok2", "other1", "leave1"})
+        self.assertEqual(self.count("message"), 2)
+        self.assertEqual(os.listdir(self.archive_dir.name), [])
+
+    def test_deletes_children_first_and_archives(self):
+        reports = retention.run_retention(batch_size=1)
+
+        self.assertTrue(all(report["finished"] for report in reports.values()))
+        self.assertEqual(self.job_nos(), {"main2", "tok2", "leave1"})
+        for name in ["message", "message_received", "message_confirm", "job_es"]:
+            self.assertEqual(self.count(name), 0)
+        self.assertEqual(self.count("job_system"), 2)
+        self.assertEqual(self.count("job_user"), 1)
+
+        [name] = os.listdir(self.archive_dir.name)
+        with gzip.open(os.path.join(self.archive_dir.name, name), "rt") as file:
+            archived = [json.loads(line) for line in file]
+        self.assertEqual([row["table"] for row in archived], ["job", "job_user", "message", "message", "message_received", "message_received", "message_confirm"])
+        self.assertEqual(archived[0]["row"]["job_no"], "other1")
+
+if __name__ == "__main__":
+    unittest.main()
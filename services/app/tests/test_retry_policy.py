@@ -0,0 +1,108 @@
+'''
+RetryPolicy and graph_batch deciding which failed Graph calls are sent again, run from services/app with python -m pytest tests or python -m unittest discover tests
+'''
+
+import unittest
+from unittest import mock
+
+import requests
+import urllib3
+
+from azure.utils import RetryPolicy, delay_decorator, graph_batch
+from models.exceptions import AzureSyncError
+
+class FakeResponse:
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.text = str(status_code)
+        self.headers = {}
+
+    def json(self):
+        return self.body
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def calls(self, policy, *outcomes):
+        '''calls policy with a function failing with each outcome in turn, returning the number of attempts made'''
+        attempts = []
+
+        def post():
+            outcome = outcomes[len(attempts)]
+            attempts.append(outcome)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return FakeResponse(outcome)
+
+        try:
+            policy.call(post, "failed", "test")
+        except AzureSyncError:
+            pass
+        return len(attempts)
+
+    def test_read_timeout_is_not_retried_for_a_post(self):
+        policy = RetryPolicy(base_delay=0, retry_read_timeouts=False)
+        self.assertEqual(self.calls(policy, requests.exceptions.ReadTimeout(), 201), 1)
+        self.assertEqual(self.calls(policy, requests.exceptions.ConnectionError(urllib3.exceptions.ProtocolError("Connection aborted.")), 201), 1)
+
+    def test_read_timeout_is_retried_by_default(self):
+        self.assertEqual(self.calls(RetryPolicy(base_delay=0), requests.exceptions.ReadTimeout(), 200), 2)
+
+    def test_errors_before_sending_are_retried_for_a_post(self):
+        policy = RetryPolicy(base_delay=0, retry_read_timeouts=False)
+        self.assertEqual(self.calls(policy, requests.exceptions.ConnectTimeout(), 201), 2)
+        self.assertEqual(self.calls(policy, requests.exceptions.ConnectionError(urllib3.exceptions.MaxRetryError(None, "/")), 201), 2)
+        self.assertEqual(self.calls(policy, 503, 201), 2)
+
+    def test_delay_decorator_passes_the_flag(self):
+        attempts = []
+
+        @delay_decorator("failed", seconds=0, retry_read_timeouts=False)
+        def _write_to_excel():
+            attempts.append(1)
+            raise requests.exceptions.ReadTimeout()
+
+        with self.assertRaises(AzureSyncError):
+            _write_to_excel()
+        self.assertEqual(len(attempts), 1)
+
+class GraphBatchTest(unittest.TestCase):
+
+    operations = [("DELETE", f"https://graph.microsoft.com/v1.0/table/rows/ItemAt(index={index})", None) for index in (5, 3)]
+
+    def post_batch(self, *outcomes):
+        '''runs graph_batch with the $batch POST returning or raising each outcome in turn, returning the error raised and the number of POSTs'''
+        posts = []
+
+        def post(url, headers, json):
+            outcome = outcomes[len(posts)]
+            posts.append(json)
+            if isinstance(outcome, Exception):
+                raise outcome
+            response = FakeResponse(200)
+            response.body = outcome
+            return response
+
+        with mock.patch("azure.utils.graph.post", side_effect=post):
+            try:
+                graph_batch(self.operations, {}, "failed", policy=RetryPolicy(base_delay=0))
+            except AzureSyncError as e:
+                return e, len(posts)
+        return None, len(posts)
+
+    def test_read_timeout_is_not_resent(self):
+        error, posts = self.post_batch(requests.exceptions.ReadTimeout(), {"responses": []})
+        self.assertIsInstance(error, AzureSyncError)
+        self.assertEqual(posts, 1)
+
+    def test_connect_timeout_is_resent(self):
+        ok = {"responses": [{"id": "0", "status": 204}, {"id": "1", "status": 204}]}
+        self.assertEqual(self.post_batch(requests.exceptions.ConnectTimeout(), ok), (None, 2))
+
+    def test_missing_response_is_a_failure(self):
+        error, posts = self.post_batch({"responses": [{"id": "0", "status": 204}]}, {"responses": []})
+        self.assertIsInstance(error, AzureSyncError)
+        self.assertEqual(posts, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -133,6 +133,22 @@ def print_all_dates(dates, date_obj=False):
     logging.info(f"formatted string: {formatted_string}")
     return formatted_string
 
+class RateLimiter:
+    '''Spaces out calls across threads to at most rate per second'''
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
 def check_obj_state(obj):
     inspector = sql_inspect(obj)
 
@@ -0,0 +1,84 @@
+from dotenv import load_dotenv
+env_path = f"/etc/environment"
+load_dotenv(dotenv_path=env_path)
+
+import logging
+import traceback
+import socket
+import sys
+
+from manage import get_app
+from extensions import remove_thread_session, get_session
+from models.jobs.abstract import Job
+from utilities import log_level
+
+logging.basicConfig(
+    filename='/var/log/worker.log',
+    filemode='a',
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=log_level
+)
+logging.getLogger('twilio.http_client').setLevel(logging.WARNING)
+
+def run_user_jobs(app):
+    '''
+    Drains the users dispatched by the webhook when ASYNC_USER_JOBS=1.
+
+    Per-user ordering is kept by Redis.start_next_job, which claims user_job:{user_id} before popping from user_jobs_queue:{user_id}, and finish_job starts the user's next queued job in the same worker
+    '''
+
+    redis_client = app.redis_client
+    logging.info("worker started")
+
+    while True:
+        user_id = redis_client.wait_for_ready_user()
+        if not user_id:
+            continue
+
+        with app.app_context():
+            try:
+                redis_client.start_next_job(user_id)
+            except Exception:
+                logging.error(traceback.format_exc())
+            finally:
+                remove_thread_session()
+
+def apply_callbacks(app):
+    '''
+    Applies the Twilio status callbacks queued by the callback endpoint when ASYNC_CALLBACKS=1.
+
+    Each batch is coalesced per sid, so only the latest status of a message is applied, and written in one transaction by Job.update_with_msg_callbacks
+    '''
+
+    redis_client = app.redis_client
+    consumer = socket.gethostname()
+    pending = True # first pick up whatever this consumer left unacknowledged before a restart
+
+    logging.info(f"callback applier {consumer} started")
+
+    while True:
+        events = redis_client.read_callback_events(consumer, pending=pending)
+        if not events:
+            pending = False
+            continue
+
+        callbacks = redis_client.coalesce_callbacks(events)
+        logging.info(f"{len(events)} callbacks coalesced into {len(callbacks)} messages")
+
+        with app.app_context():
+            try:
+                Job.apply_msg_callbacks(callbacks)
+            except Exception:
+                get_session().rollback()
+                logging.error(traceback.format_exc())
+            finally:
+                # a failed batch is not retried, same as a failed callback request
+                redis_client.ack_callback_events([entry_id for entry_id, _ in events])
+                remove_thread_session()
+
+if __name__ == "__main__":
+    app = get_app()
+    if len(sys.argv) > 1 and sys.argv[1] == "callbacks":
+        apply_callbacks(app)
+    else:
+        run_user_jobs(app)